@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import tempfile
+import argparse
+import multiprocessing as mp
+import numpy as np
+import plots
+from constants import *
+from resources import ResourceMonitor
+
+# times every figure kind against synthetic caches of 20, 200, 2000... samples.
+# the real sample ids are always the first 20 so the representative/concat figures
+# still find their samples, the rest are SYN0001.. spread over the three types.
+# at most --limit figures of each kind are drawn, s/figure is scaled up to the full count
+#
+#   python bench_plots.py --sizes 20,200,2000 --threads 8
+#
+# --startup times main.py itself in fresh interpreters instead: a bare import of plots,
+# --rebuild-cache with nothing changed and a render where every figure is up to date.
+# one untimed run first brings the cache and the figures up to date
+#
+#   python bench_plots.py --startup --output-dir /tmp/plots
+
+SYNTH_TYPES   = {'fresh': 'Fresh', 'silica': 'Silica', 'herbaria': 'Herbarium'}
+HEAVY_IMPORTS = ('matplotlib.pyplot', 'pandas')
+
+
+def synth_entry(rng):
+    pcts   = rng.dirichlet([8, 1, 1, 2]) * 100
+    counts = np.round(pcts * 25).astype(int)
+    x      = np.arange(1, 801)
+    y      = (rng.uniform(200, 2000) * np.exp(-((x - rng.uniform(80, 250)) / rng.uniform(40, 120)) ** 2)).astype(int)
+    decay  = np.exp(-np.arange(25) / rng.uniform(2, 6))
+    edges  = np.linspace(0.0, 1.0, CONTIG_BINS + 1)
+    hists  = {c: rng.multinomial(10_000, rng.dirichlet(np.ones(CONTIG_BINS))) for c in CONTIG_SCORE_COLS}
+    return {
+        'busco'      : dict(zip(BUSCO_CATEGORIES, pcts.tolist()), **{f'{k}_count': int(c) for k, c in zip(BUSCO_CATEGORIES, counts)}),
+        'deamination': {'5p_CtoT': (0.0002 + 0.0015 * decay).tolist(), '5p_AtoG': (0.0002 + 0.0002 * decay).tolist(),
+                        '3p_CtoT': (0.0002 + 0.0015 * decay[::-1]).tolist(), '3p_AtoG': (0.0002 + 0.0002 * decay[::-1]).tolist()},
+        'inserts'    : {'x': x, 'y': y},
+        'transrate'  : rng.uniform(0.1, 0.9, 4).tolist(),
+        'transrate_contigs': {
+            'edges'    : edges.tolist(),
+            'contigs'  : 10_000,
+            'counts'   : {c: h.tolist() for c, h in hists.items()},
+            'quantiles': {c: {str(q): float(np.interp(q, np.cumsum(h) / h.sum(), edges[1:])) for q in CONTIG_QUANTILES}
+                          for c, h in hists.items()},
+        },
+    }
+
+
+# swaps the module level sample tables and cache in plots for n synthetic samples
+def install(n, seed=0):
+    rng     = np.random.default_rng(seed)
+    samples = dict(list(SAMPLES.items())[:n])
+    names   = {s: SAMPLE_NAMES[s] for s in samples}
+    types   = list(SYNTH_TYPES.items())
+    for i in range(1, n - len(samples) + 1):
+        sample          = f'SYN{i:04d}'
+        samples[sample] = sample
+        names[sample]   = f'Synth{i}-{types[i % len(types)][1]}'
+    cache = {s: synth_entry(rng) for s in samples}
+    cache['inserts_y'] = {'max_inserts_y': max(int(e['inserts']['y'].max()) for s, e in cache.items()) * 1.1}
+    plots.SAMPLES      = samples
+    plots.SAMPLE_NAMES = names
+    plots.CACHE        = cache
+    return samples
+
+
+def run(jobs, threads):
+    monitor = ResourceMonitor(os.getpid(), interval=0.2)
+    start   = time.perf_counter()
+    if threads > 1:
+        plots.import_render_modules()
+        pool = mp.Pool(processes=threads)
+        try:
+            failed = plots.run_jobs(jobs, pool)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        failed = plots.run_jobs(jobs)
+    elapsed = time.perf_counter() - start
+    return elapsed, monitor.stop()['peak_rss'], failed
+
+
+def bench(n, plot_types, output_dir, threads, limit):
+    install(n)
+    jobs  = plots.figure_jobs(plot_types, output_dir)
+    kinds = {}
+    for job in jobs:
+        kinds.setdefault(job.name.split(':')[0], []).append(job)
+
+    rows = []
+    for kind, group in kinds.items():
+        # spread over the group so every plot type is in the timed individual plots
+        timed = group[::max(1, len(group) // limit)][:limit]
+        elapsed, peak, failed = run(timed, threads)
+        per   = elapsed / len(timed)
+        rows.append((n, kind, len(group), len(timed), per, per * len(group), peak / 1024 ** 2, len(failed)))
+    return rows
+
+
+# which of HEAVY_IMPORTS the command pulled in, off python's own import timing
+def heavy_imports(cmd):
+    env  = dict(os.environ, PYTHONPROFILEIMPORTTIME='1')
+    err  = subprocess.run(cmd, cwd=SCRIPT_DIR, env=env, capture_output=True, text=True).stderr
+    seen = {line.rsplit('|', 1)[-1].strip() for line in err.splitlines() if line.startswith('import time:')}
+    return [m for m in HEAVY_IMPORTS if m in seen]
+
+
+def startup(output_dir, threads, repeats):
+    main_py = os.path.join(SCRIPT_DIR, 'main.py')
+    cases   = {
+        'import plots'  : [sys.executable, '-c', 'import plots'],
+        'rebuild-cache' : [sys.executable, main_py, '--rebuild-cache'],
+        'up to date'    : [sys.executable, main_py, '--output-dir', output_dir, '--threads', str(threads)],
+    }
+    rows = []
+    for name, cmd in cases.items():
+        subprocess.run(cmd, cwd=SCRIPT_DIR, check=True, capture_output=True)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(cmd, cwd=SCRIPT_DIR, check=True, capture_output=True)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        rows.append((name, times[len(times) // 2], times[0], heavy_imports(cmd)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plotting benchmark on synthetic caches')
+    parser.add_argument('--sizes',      default='20,200,2000')
+    parser.add_argument('--plot-types', default='busco,deamination,inserts,transrate,transrate_contigs')
+    parser.add_argument('--threads',    type=int, default=1)
+    parser.add_argument('--limit',      type=int, default=40)    # figures drawn per kind and size
+    parser.add_argument('--output-dir', default=None)            # kept if given, otherwise a temp dir
+    parser.add_argument('--startup',    action='store_true')
+    parser.add_argument('--repeats',    type=int, default=5)     # timed runs per --startup case
+    args = parser.parse_args()
+
+    if args.startup:
+        output_dir = os.path.abspath(args.output_dir or os.path.join(SCRIPT_DIR, '01_plots'))
+        print(f"\n{'case':<16}{'median ms':>10}{'min ms':>10}  imported")
+        for name, median, fastest, heavy in startup(output_dir, args.threads, args.repeats):
+            print(f"{name:<16}{median * 1000:>10.0f}{fastest * 1000:>10.0f}  {', '.join(heavy) or '-'}")
+        return
+
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='bench_plots_')
+    plot_types = args.plot_types.split(',')
+    rows       = []
+    try:
+        for n in [int(x) for x in args.sizes.split(',')]:
+            rows += bench(n, plot_types, os.path.join(output_dir, str(n)), args.threads, args.limit)
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(f"\n{'samples':>8}  {'figure':<18}{'count':>7}{'timed':>7}{'s/figure':>10}{'total s':>10}{'peak MB':>10}")
+    for n, kind, count, timed, per, total, peak, failed in rows:
+        note = f'  {failed} failed' if failed else ''
+        print(f'{n:>8}  {kind:<18}{count:>7}{timed:>7}{per:>10.2f}{total:>10.1f}{peak:>10.0f}{note}')
+
+
+if __name__ == '__main__':
+    main()
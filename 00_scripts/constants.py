@@ -1,34 +1,18 @@
 import os
+import registry
 
 # script path and where the data is cached
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR   = os.path.join(os.path.dirname(SCRIPT_DIR), '02_data')
-CACHE_FILE = os.path.join(SCRIPT_DIR, 'plot_data_cache.pkl')
-
-SAMPLES = {
-    'WA02'  : 'WA02_paired', 'WA03'  : 'WA03_paired', 'WA07'  : 'WA07_paired',
-    'WA08'  : 'WA08_paired', 'WA09'  : 'WA09_paired', 'WA11'  : 'WA11_paired',
-    'WA12'  : 'WA12_paired', 'WA13'  : 'WA13_paired', 'WA14'  : 'WA14_paired',
-    'WA18'  : 'WA18_paired', 'WA22'  : 'WA22_paired', 'WA25'  : 'WA25_paired',
-    'WA26'  : 'WA26_paired', 'DAL192': 'DAL192',      'DAL193': 'DAL193',
-    'DAL195': 'DAL195',      'DAL212': 'DAL212',      'DAL218': 'DAL218',
-    'DAL224': 'DAL224',      'DAL227': 'DAL227'
-}
+CACHE_DIR  = os.path.join(SCRIPT_DIR, 'plot_data_cache')
+CACHE_FILE = os.path.join(SCRIPT_DIR, 'plot_data_cache.pkl') # old pickled cache, converted into CACHE_DIR on first load
 
-SAMPLE_NAMES = {
-    'WA02'  : 'Darlingtonia1-Silica',  'WA03'  : 'Ipomopsis-Silica',
-    'WA07'  : 'Leucothoe-Silica',      'WA08'  : 'Darlingtonia2-Silica',
-    'WA09'  : 'Primula-Silica',        'WA11'  : 'Pyrola-Silica',
-    'WA12'  : 'Navarretia-Silica',     'WA13'  : 'Collomia-Silica',
-    'WA14'  : 'Vaccinium-Silica',      'WA18'  : 'Cyclamen-Silica',
-    'WA22'  : 'Antistrophe-Herbarium', 'WA25'  : 'Jacquinia-Herbarium',
-    'WA26'  : 'Clavija-Herbarium',     'DAL192': 'Collomia-Fresh',
-    'DAL193': 'Navarretia-Fresh',      'DAL195': 'Pyrola-Fresh',
-    'DAL212': 'Vaccinium-Fresh',       'DAL218': 'Ipomopsis-Fresh',
-    'DAL224': 'Leucothoe-Fresh',       'DAL227': 'Darlingtonia1-Fresh'
-}
+# the samples themselves are in samples.tsv, see registry.py
+REGISTRY     = registry.load()
+SAMPLES      = REGISTRY.stems()
+SAMPLE_NAMES = REGISTRY.names()
+SAMPLE_TYPES = REGISTRY.types()
 
-SAMPLE_TYPES           = {'WA22': 'herbaria', 'WA13': 'silica', 'DAL192': 'fresh'}
 REPRESENTATIVE_SAMPLES = ['WA22', 'DAL192', 'WA13']
 
 COLORS = {
@@ -55,6 +39,11 @@ BUSCO_LABELS      = ['Complete\nSingle-copy', 'Complete\nDuplicated', 'Fragmente
 TRANSRATE_COLS    = ['sCnuc_Harmonic', 'sCcov_Harmonic', 'sCord_Harmonic', 'sCseg_Harmonic']
 TRANSRATE_LABELS  = ['sCnuc', 'sCcov', 'sCord', 'sCseg']
 
+# per contig scores from contigs.csv, same order as TRANSRATE_COLS so the colors line up
+CONTIG_SCORE_COLS = ['sCnuc', 'sCcov', 'sCord', 'sCseg']
+CONTIG_BINS       = 100
+CONTIG_QUANTILES  = [0.05, 0.25, 0.5, 0.75, 0.95]
+
 TYPE_ORDER        = ('fresh', 'silica', 'herbaria')
 TYPE_DISPLAY      = {'fresh': 'Fresh', 'silica': 'Silica', 'herbaria': 'Herbarium'}
 
@@ -72,6 +61,7 @@ ROW_TITLES = {
     'inserts':     'Insert Length',
     'transrate':   'TransRate2',
     'busco':       'BUSCO',
+    'transrate_contigs': 'Contig Scores',
 }
 
 FIGSIZE = {
@@ -79,18 +69,24 @@ FIGSIZE = {
     'deamination': (10, 6), # 3 plots = 10
     'inserts':     (10, 6),
     'transrate':   (8,  6),
+    'transrate_contigs': (10, 6),
 }
 
 FIGSIZE_REP              = (38.48, 13.2) # 52.76 / 4
 FIGSIZE_TRANSRATE_SCORES = (16,    12)
 FIGSIZE_BUSCO_SCORES     = (16,    12)
 FIGSIZE_CONCAT           = (38.48, 52.76) # tried to make this proportional to an 8x11 page
+FIGSIZE_OVERLAY          = (12,    7)
+
+# ribbon and line of the per type overlays, lower/upper quantile and the median
+OVERLAY_QUANTILES = (0.25, 0.5, 0.75)
 
 TITLE_SUFFIX = {
     'busco':       ' BUSCO Scores',
     'deamination': ' Deamination Pattern',
     'inserts':     ' Insert Length Distribution',
     'transrate':   ' Transrate2 Scores',
+    'transrate_contigs': ' Contig Score Distribution',
 }
 
 
@@ -127,6 +123,11 @@ FONTS_SLIDE = {
 FONT_ROW_LABEL = 48 * SCALE
 FONT_ROW_TITLE = 24 * SCALE
 
+# png encoding threads per render worker, and the point count above which --rasterize-svg
+# turns a line into an embedded image in svg output
+ENCODE_THREADS    = 2
+DENSE_LINE_POINTS = 500
+
 # as close as i could get to powerpoint dimensions
 SLIDE_FIGSIZE = (13.33, 7.5)
 SLIDE_NCOLS   = 5
@@ -0,0 +1,125 @@
+import os
+import json
+
+# shared sample discovery for 03_transrate, 03_inserts and 03_deamination.
+# only the top level DAL*/WA* directories (and their transrate2/<organelle> dirs) are
+# scanned, never the whole tree. each sample is cached in the index with the mtimes
+# of the directories it was built from, and only rescanned when one of those changes.
+
+INDEX_FILE      = '.herbaria_index.json'
+SAMPLE_PREFIXES = ('DAL', 'WA')
+ORGANELLES      = ('chloro', 'mito', 'nuclear')
+
+
+def scan_files(path):
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    return sorted(files), sorted(dirs)
+
+
+class SampleIndex:
+    def __init__(self, root='.', index_file=INDEX_FILE):
+        self.root       = root
+        self.index_file = os.path.join(root, index_file)
+        self.samples    = {}
+        self.changed    = []
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    self.samples = json.load(f)
+            except (OSError, ValueError):
+                self.samples = {}
+
+    # directories whose mtime decides if a sample entry is still good
+    def watched_dirs(self, sample):
+        dirs = [sample]
+        tr2  = os.path.join(sample, 'transrate2')
+        if os.path.isdir(os.path.join(self.root, tr2)):
+            dirs.append(tr2)
+            dirs += [os.path.join(tr2, o) for o in ORGANELLES if os.path.isdir(os.path.join(self.root, tr2, o))]
+        return dirs
+
+    def mtimes(self, sample):
+        return {d: os.stat(os.path.join(self.root, d)).st_mtime_ns for d in self.watched_dirs(sample)}
+
+    def scan_sample(self, sample):
+        entry = {'assembly': '', 'chloro': [], 'mito': [], 'nuclear': [], 'fasta': [],
+                 'bam': {o: [] for o in ORGANELLES}, 'csv': {o: [] for o in ORGANELLES}}
+        files, dirs = scan_files(os.path.join(self.root, sample))
+        for file in files:
+            if file.endswith('.cds.fa'):
+                entry['assembly'] = file
+            elif file.startswith('chloro'):
+                entry['chloro'].append(file)
+            elif file.startswith('mito'):
+                entry['mito'].append(file)
+            elif file.startswith('nuclear'):
+                entry['nuclear'].append(file)
+            if file.endswith('.fa'):
+                entry['fasta'].append(file)
+        if 'transrate2' in dirs:
+            for organelle in ORGANELLES:
+                org_dir = os.path.join(self.root, sample, 'transrate2', organelle)
+                if not os.path.isdir(org_dir):
+                    continue
+                org_files, _ = scan_files(org_dir)
+                entry['bam'][organelle] = [f for f in org_files if f.endswith('sorted.bam')]
+                entry['csv'][organelle] = [f for f in org_files if f.endswith('.csv')]
+        entry['mtimes'] = self.mtimes(sample)
+        return entry
+
+    def refresh(self, force=False):
+        self.changed = []
+        found = set()
+        with os.scandir(self.root) as it:
+            for d in it:
+                if d.is_dir() and d.name.startswith(SAMPLE_PREFIXES):
+                    found.add(d.name)
+        for sample in sorted(found):
+            entry = self.samples.get(sample)
+            if force or entry is None or entry.get('mtimes') != self.mtimes(sample):
+                self.samples[sample] = self.scan_sample(sample)
+                self.changed.append(sample)
+        for sample in list(self.samples):
+            if sample not in found:
+                del self.samples[sample]
+                self.changed.append(sample)
+        if self.changed:
+            self.save()
+        return self.changed
+
+    # per process tmp name, the pipeline runs several stages that refresh the same index at once
+    def save(self):
+        tmp = f'{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.samples, f, indent=4)
+        os.replace(tmp, self.index_file)
+
+    # the old pathDict.json layout used by 03_transrate
+    def path_dict(self):
+        return {s: {'assembly': e['assembly'], 'chloro': e['chloro'], 'mito': e['mito'], 'nuclear': e['nuclear']}
+                for s, e in sorted(self.samples.items())}
+
+    def bams(self, organelles=ORGANELLES, suffix='sorted.bam'):
+        return [os.path.join(s, 'transrate2', o, f)
+                for s, e in sorted(self.samples.items())
+                for o in organelles
+                for f in e['bam'].get(o, []) if f.endswith(suffix)]
+
+    def fastas(self):
+        return [os.path.join(s, f) for s, e in sorted(self.samples.items()) for f in e['fasta']]
+
+    def csvs(self, organelle='nuclear'):
+        return {s: [os.path.join(s, 'transrate2', organelle, f) for f in e['csv'].get(organelle, [])]
+                for s, e in sorted(self.samples.items())}
+
+
+def load_index(root='.', force=False):
+    index = SampleIndex(root)
+    index.refresh(force=force)
+    return index
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+
+# run ledger shared by every stage. one row per (sample, organelle, stage) attempt,
+# appended when it starts and closed when it ends. sqlite in WAL mode with full sync,
+# so several schedulers (or threads in one) can claim and finish jobs at the same time.
+
+LEDGER_FILE = 'ledger.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attempts (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample      TEXT NOT NULL,
+    organelle   TEXT NOT NULL,
+    stage       TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    start       REAL,
+    end         REAL,
+    fingerprint TEXT,
+    host        TEXT,
+    pid         INTEGER,
+    input_bytes INTEGER,
+    resources   TEXT
+);
+CREATE INDEX IF NOT EXISTS attempts_key ON attempts (stage, sample, organelle, status);
+'''
+
+
+# columns added after the first version of the table, added in place on older ledgers
+COLUMNS = {'input_bytes': 'INTEGER', 'resources': 'TEXT'}
+
+
+def input_bytes(paths):
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+# size + mtime of every input, cheap enough to run on the fastqs before each job
+def fingerprint(paths):
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+            h.update(f'{path}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+        except OSError:
+            h.update(f'{path}\0missing\n'.encode())
+    return h.hexdigest()
+
+
+# attempts imported from progress.json have no fingerprint, they stay done whatever the inputs
+def up_to_date(old_fp, fp):
+    return old_fp is None or old_fp == fp
+
+
+class Ledger:
+    def __init__(self, path=LEDGER_FILE, timeout=60):
+        self.path = path
+        self.host = socket.gethostname()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.executescript(SCHEMA)
+        existing = {row[1] for row in self.conn.execute('PRAGMA table_info(attempts)')}
+        for column, kind in COLUMNS.items():
+            if column not in existing:
+                self.conn.execute(f'ALTER TABLE attempts ADD COLUMN {column} {kind}')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # a running attempt only blocks others while the process that owns it is alive
+    def alive(self, host, pid):
+        if host != self.host:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    # atomically start an attempt unless its latest finished one had the same inputs, or it's running elsewhere
+    def claim(self, sample, organelle, stage, inputs=()):
+        fp = fingerprint(inputs)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    "SELECT id, status, fingerprint, host, pid FROM attempts "
+                    "WHERE stage=? AND sample=? AND organelle=? AND status IN ('done', 'running') ORDER BY id",
+                    (stage, sample, organelle)).fetchall()
+                done = [old_fp for _, status, old_fp, _, _ in rows if status == 'done']
+                if done and up_to_date(done[-1], fp):
+                    self.conn.execute('COMMIT')
+                    return None
+                for attempt_id, status, old_fp, host, pid in rows:
+                    if status == 'running':
+                        if self.alive(host, pid):
+                            self.conn.execute('COMMIT')
+                            return None
+                        self.conn.execute("UPDATE attempts SET status='abandoned', end=? WHERE id=?",
+                                          (time.time(), attempt_id))
+                cur = self.conn.execute(
+                    "INSERT INTO attempts (sample, organelle, stage, status, start, fingerprint, host, pid, input_bytes) "
+                    "VALUES (?, ?, ?, 'running', ?, ?, ?, ?, ?)",
+                    (sample, organelle, stage, time.time(), fp, self.host, os.getpid(), input_bytes(inputs)))
+                self.conn.execute('COMMIT')
+                return cur.lastrowid
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def finish(self, attempt_id, status, resources=None):
+        with self.lock:
+            self.conn.execute('UPDATE attempts SET status=?, end=?, resources=? WHERE id=?',
+                              (status, time.time(), json.dumps(resources) if resources else None, attempt_id))
+
+    def record(self, sample, organelle, stage, status, inputs=(), start=None, end=None, resources=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO attempts (sample, organelle, stage, status, start, end, fingerprint, host, pid, input_bytes, resources) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (sample, organelle, stage, status, start, end, fingerprint(inputs) if inputs else None,
+                 self.host, os.getpid(), input_bytes(inputs), json.dumps(resources) if resources else None))
+
+    # {sample: [organelle, ...]} of everything finished, same shape progress.json had
+    def completed(self, stage):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT sample, organelle FROM attempts WHERE stage=? AND status='done' ORDER BY id",
+                (stage,)).fetchall()
+        done = {}
+        for sample, organelle in rows:
+            done.setdefault(sample, []).append(organelle)
+        return done
+
+    # {(sample, organelle): fingerprint} of the latest finished attempt of a stage
+    def fingerprints(self, stage):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT sample, organelle, fingerprint FROM attempts WHERE stage=? AND status='done' ORDER BY id",
+                (stage,)).fetchall()
+        return {(sample, organelle): fp for sample, organelle, fp in rows}
+
+    def attempts(self, stage=None):
+        query, params = 'SELECT * FROM attempts', ()
+        if stage:
+            query, params = query + ' WHERE stage=?', (stage,)
+        with self.lock:
+            cur  = self.conn.execute(query + ' ORDER BY id', params)
+            cols = [c[0] for c in cur.description]
+            rows = [dict(zip(cols, row)) for row in cur.fetchall()]
+        for row in rows:
+            row['resources'] = json.loads(row['resources']) if row.get('resources') else None
+        return rows
+
+    # one time import of the old progress.json
+    def import_progress(self, path, stage):
+        if not os.path.exists(path) or self.completed(stage):
+            return
+        with open(path) as f:
+            progress_data = json.load(f)
+        for sample, organelles in progress_data.items():
+            for organelle in organelles:
+                self.record(sample, organelle, stage, 'done')
@@ -1,17 +1,85 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import time
 import argparse
+import importlib
+import constants
+import registry
+import profiling
+import plots
 from plots import (
     build_cache, get_cache,
-    plot_rep, plot_individual,
-    concat_rep,
-    plot_transrate_scores,
-    plot_busco_categories,
+    figure_jobs, render,
 )
 
 # comma seperate which of these you want to run
-KNOWN_TYPES = ('busco', 'deamination', 'inserts', 'transrate')
+KNOWN_TYPES = ('busco', 'deamination', 'inserts', 'transrate', 'transrate_contigs')
+
+
+# constants.py, plots.py, the manifest, the cache index and every selected source file (or results.sqlite with --from-store)
+def watched_files(from_store, samples=None):
+    files = [os.path.join(constants.SCRIPT_DIR, 'constants.py'), os.path.abspath(plots.__file__),
+             registry.manifest_path(), os.path.join(plots.CACHE_DIR, 'index.json')]
+    if from_store:
+        from store import STORE_FILE
+        files.append(STORE_FILE)
+    else:
+        files += [path for s in plots.SAMPLES if registry.selected(s, samples) for path, _ in plots.sample_sources(s).values()]
+    return files
+
+
+def mtimes(files):
+    stamps = {}
+    for path in files:
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+# keeps this interpreter (matplotlib, fonts, the cache) warm and polls for changes. code changes
+# reload constants/plots, data changes reparse only the changed entries, and the render keys
+# then pick out the figures that actually depend on what changed. everything renders in process
+def watch(args, plot_types, samples=None):
+    code  = {os.path.join(constants.SCRIPT_DIR, 'constants.py'), os.path.abspath(plots.__file__), registry.manifest_path()}
+    index = os.path.join(plots.CACHE_DIR, 'index.json')
+    seen  = mtimes(watched_files(args.from_store, samples))
+    print(f"Watching {len(seen)} files, ctrl-c to stop")
+    while True:
+        time.sleep(args.interval)
+        now     = mtimes(watched_files(args.from_store, samples))
+        changed = {f for f in set(seen) | set(now) if seen.get(f) != now.get(f)}
+        if not changed:
+            continue
+        start = time.perf_counter()
+        try:
+            if changed & code:
+                registry.REGISTRY = None
+                importlib.reload(constants)
+                importlib.reload(plots)
+            if changed - code - {index}:
+                plots.CACHE = plots.build_cache(from_store=args.from_store, workers=1, samples=samples)
+            elif index in changed:
+                plots.CACHE = None
+            jobs   = plots.figure_jobs(plot_types, args.output_dir,
+                                       representative=not args.individual_only,
+                                       individual=not args.representative_only,
+                                       template=args.template,
+                                       rasterize=args.rasterize_svg,
+                                       ribbons=not args.no_ribbons,
+                                       samples=samples)
+            failed = plots.render(jobs, args.output_dir)
+            if failed:
+                print(f"{len(failed)} figures failed: {', '.join(sorted(failed))}")
+        except Exception as e:
+            # usually a half saved edit, wait for the next one
+            print(f"Warning: update failed:\n{e!r}")
+        print(f"Updated in {time.perf_counter() - start:.2f} s")
+        # taken after the update so our own cache writes don't trigger another round
+        seen = mtimes(watched_files(args.from_store, samples))
 
 
 def main():
@@ -20,34 +88,57 @@ def main():
     parser.add_argument('--output-dir', default='./01_plots')
     parser.add_argument('--representative-only', action='store_true')
     parser.add_argument('--individual-only',     action='store_true')
-    parser.add_argument('--threads',  type=int, default=16)         #multithread the individual plots 
+    parser.add_argument('--threads',  type=int, default=16)         # size of the render pool
     parser.add_argument('--rebuild-cache', action='store_true')
+    parser.add_argument('--from-store',    action='store_true')      # rebuild the cache from store.py's results.sqlite
+    parser.add_argument('--full-rebuild',  action='store_true')      # reparse everything, not just the changed files
+    parser.add_argument('--force-render',  action='store_true')      # redraw figures even if their render key hasn't changed
+    parser.add_argument('--template',      action='store_true')      # reuse one figure per type and worker for the individual plots
+    parser.add_argument('--rasterize-svg', action='store_true')      # draw dense lines as images inside the svg
+    parser.add_argument('--no-ribbons',    action='store_true')      # overlays without the per type median/quantile ribbons
+    parser.add_argument('--watch',         action='store_true')      # stay up and re-render whatever an edit affects
+    parser.add_argument('--interval', type=float, default=0.2)      # --watch polling interval in seconds
+    registry.add_arguments(parser)                                   # only reparse and redraw these samples
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    profiling.setup('plots', args)
+    samples = registry.selection(args)
 
     if args.rebuild_cache:
         # pickles the data which makes reruns and tuning pplots faster
-        build_cache()
+        with profiling.stage('cache', unit='entries') as rec:
+            rec['items'] = len(build_cache(from_store=args.from_store, full=args.full_rebuild, workers=args.threads,
+                                           samples=samples).changed)
         return
 
-    get_cache()
+    with profiling.stage('cache', unit='entries') as rec:
+        if args.watch:
+            # start from a cache that matches the files on disk, the watcher only sees changes from here on
+            plots.CACHE = build_cache(from_store=args.from_store, workers=args.threads, samples=samples)
+        rec['items'] = len(get_cache().changed)
     plot_types = [pt for pt in args.plot_types.split(',') if pt.strip() in KNOWN_TYPES]
     os.makedirs(args.output_dir, exist_ok=True)
 
-    if not args.individual_only:
-        # this is going to end up rebuilding the same dictionary every loop but shouldnt slow down the script in any meaningful way
-        for pt in plot_types:
-            plot_rep(pt, args.output_dir)
-        if len(plot_types) > 1:
-            concat_rep(args.output_dir, plot_types)
-        if 'transrate' in plot_types:
-            plot_transrate_scores(args.output_dir)
-        if 'busco' in plot_types:
-            plot_busco_categories(args.output_dir)
-
-    if not args.representative_only:
-        for pt in plot_types:
-            plot_individual(pt, args.output_dir, args.threads)
-
+    # one pool for every figure, the representative and individual plots all go in the same run.
+    # --watch renders in process after it, the workers would still have the old code and cache
+    jobs = figure_jobs(plot_types, args.output_dir,
+                       representative=not args.individual_only,
+                       individual=not args.representative_only,
+                       template=args.template,
+                       rasterize=args.rasterize_svg,
+                       ribbons=not args.no_ribbons,
+                       samples=samples)
+    with plots.RenderPool(args.threads) as pool:
+        failed = render(jobs, args.output_dir, pool, force=args.force_render)
+    if failed:
+        print(f"{len(failed)} figures failed: {', '.join(sorted(failed))}")
+    if args.watch:
+        try:
+            watch(args, plot_types, samples)
+        except KeyboardInterrupt:
+            return
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
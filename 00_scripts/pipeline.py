@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from constants import *
+from discovery import load_index
+from ledger import Ledger, LEDGER_FILE, fingerprint, input_bytes
+from resources import CoreBudget, suggest_threads
+import registry
+import profiling
+from plots import sample_sources
+
+# make style runner for the whole chain, from the transrate2 runs down to the figures:
+#
+#   transrate -> scan ----> publish -> cache -> plots
+#             -> contigs ------------>
+#
+# every stage declares its inputs and outputs per sample (the aggregates once for all
+# samples). a stage is up to date for a sample when its outputs are there, the ledger has
+# a finished attempt with the same input fingerprint (size + mtime) and none of the
+# stages it depends on is running for that sample. so a new specimen only runs its own
+# chain, then cache and plots which only redo what changed themselves.
+#
+# by default each sample goes down its chain on its own, as soon as its upstream outputs
+# exist, and every stage's jobs share one CoreBudget of --threads cores. --barrier runs one
+# stage at a time for every sample instead.
+#
+# --samples/--types keep the per sample stages to a subset, cache and plots still run over
+# everything but only redo what changed anyway.
+#
+#   python pipeline.py --dry-run
+#   python pipeline.py --stages scan,publish,cache,plots --threads 8
+#   python pipeline.py --types herbaria
+
+REPO_DIR  = os.path.dirname(SCRIPT_DIR)
+AGGREGATE = 'all'       # ledger sample of the cross sample stages
+ORGANELLE = 'nuclear'   # everything downstream of transrate2 is the nuclear assembly
+
+# for contig_stats, at the end so 03_transrate's main.py doesn't shadow anything here
+sys.path.append(os.path.join(REPO_DIR, '03_transrate'))
+
+# inputs/outputs are fn(pipe, sample) -> paths, run is fn(pipe, samples, threads) with only the stale
+# samples, threads fn(pipe, sample) -> cores one sample's job takes out of the budget (1 if None).
+# fresh stages only count as done when the run itself rewrote their outputs, old ones left over don't
+Stage = namedtuple('Stage', ['name', 'deps', 'inputs', 'outputs', 'run', 'aggregate', 'threads', 'fresh'],
+                   defaults=[False, None, True])
+
+
+def tr2_path(pipe, sample, name):
+    return pipe.path(sample, 'transrate2', 'nuclear', name)
+
+
+# the postSample bam transrate2 left for the sample, its name is what scan.py names the outputs after
+def bam_name(pipe, sample):
+    bams = [b for b in pipe.index.samples[sample]['bam']['nuclear'] if b.endswith('.postSample.sorted.bam')]
+    return bams[0] if bams else None
+
+
+def scan_stem(pipe, sample):
+    bam = bam_name(pipe, sample)
+    return bam.split('.')[0] if bam else sample
+
+
+def transrate_inputs(pipe, sample):
+    entry = pipe.index.samples[sample]
+    return [pipe.path(sample, f) for f in [entry['assembly']] + entry['nuclear']]
+
+
+def transrate_outputs(pipe, sample):
+    return [tr2_path(pipe, sample, 'assembly.csv'), tr2_path(pipe, sample, 'contigs.csv')]
+
+
+# the same split transrate2's main.py makes, --job-threads for the sample with the most reads
+# and the rest by their share of that. the bam scan scales with the reads too
+def read_threads(pipe, sample):
+    if pipe.read_bytes is None:
+        pipe.read_bytes = {s: input_bytes(transrate_inputs(pipe, s)) for s in pipe.samples()}
+    largest = max(pipe.read_bytes.values(), default=0)
+    share   = pipe.read_bytes.get(sample, largest) / largest if largest else 1
+    return max(1, round(pipe.job_threads * share))
+
+
+# capped at what past transrate2 runs really kept busy
+def transrate_threads(pipe, sample):
+    return min(read_threads(pipe, sample), suggest_threads(pipe.ledger, 'transrate', ORGANELLE, pipe.job_threads))
+
+
+# main.py's own ledger claims still skip a job another scheduler already did
+def run_transrate(pipe, samples, threads):
+    pipe.command([sys.executable, os.path.join(REPO_DIR, '03_transrate', 'main.py'), '-o', 'nuclear',
+                  '-c', str(threads), '-t', str(min(threads, pipe.job_threads)), '--samples', ','.join(samples)],
+                 pipe.root)
+
+
+def scan_inputs(pipe, sample):
+    bam = bam_name(pipe, sample)
+    if bam is None:
+        return []
+    stem   = bam.split('.')[0]
+    fastas = [f for f in pipe.index.samples[sample]['fasta'] if f.split('.')[0] == stem]
+    return [tr2_path(pipe, sample, bam)] + [pipe.path(sample, f) for f in fastas[-1:]]
+
+
+def scan_outputs(pipe, sample):
+    stem = scan_stem(pipe, sample)
+    return [pipe.path('read_distance', f'{stem}.csv'), pipe.path('deamination', stem, 'misincorporation.txt')]
+
+
+# scan.py skips a bam whose outputs exist, so the stale ones are removed first
+def run_scan(pipe, samples, threads):
+    for sample in samples:
+        for path in scan_outputs(pipe, sample):
+            if os.path.exists(path):
+                os.remove(path)
+    pipe.command([sys.executable, os.path.join(REPO_DIR, '03_inserts', 'scan.py'),
+                  '--workers', str(threads), '--samples', ','.join(samples)], pipe.root)
+
+
+def contigs_inputs(pipe, sample):
+    return [tr2_path(pipe, sample, 'contigs.csv')]
+
+
+def contigs_outputs(pipe, sample):
+    return [sample_sources(sample)['transrate_contigs'][0]]
+
+
+# imported here, it pulls in pandas which a --dry-run doesn't need
+def run_contigs(pipe, samples, threads):
+    from contig_stats import write_summary
+    for sample in samples:
+        try:
+            write_summary(sample, contigs_inputs(pipe, sample)[0], contigs_outputs(pipe, sample)[0])
+        except Exception as e:
+            print(f"Warning: contig summary failed for {sample}:\n{e}")
+
+
+# what grab_tr2_assembly.py and the hand copies into 02_data did, one sample at a time
+def publish_inputs(pipe, sample):
+    return [tr2_path(pipe, sample, 'assembly.csv')] + scan_outputs(pipe, sample)
+
+
+def publish_outputs(pipe, sample):
+    sources = sample_sources(sample)
+    return [sources[key][0] for key in ('transrate', 'inserts', 'deamination')]
+
+
+# copy2 keeps the mtimes, so the cache only reparses files whose contents really moved.
+# that's also why publish isn't a fresh stage
+def run_publish(pipe, samples, threads):
+    for sample in samples:
+        for src, dst in zip(publish_inputs(pipe, sample), publish_outputs(pipe, sample)):
+            if os.path.exists(src):
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(src, dst)
+
+
+def cache_inputs(pipe, sample):
+    return sorted({path for s in SAMPLES for path, _ in sample_sources(s).values()})
+
+
+def cache_outputs(pipe, sample):
+    return [os.path.join(CACHE_DIR, 'index.json')]
+
+
+def run_cache(pipe, samples, threads):
+    pipe.command([sys.executable, os.path.join(SCRIPT_DIR, 'main.py'), '--rebuild-cache',
+                  '--threads', str(threads)], SCRIPT_DIR)
+
+
+def plots_inputs(pipe, sample):
+    return cache_outputs(pipe, sample) + [os.path.join(SCRIPT_DIR, f) for f in ('constants.py', 'plots.py')] + [registry.manifest_path()]
+
+
+def plots_outputs(pipe, sample):
+    return [os.path.join(pipe.output_dir, '.render_keys.json')]
+
+
+# main.py's render keys redraw just the figures of the changed samples plus the aggregate ones
+def run_plots(pipe, samples, threads):
+    pipe.command([sys.executable, os.path.join(SCRIPT_DIR, 'main.py'), '--output-dir', pipe.output_dir,
+                  '--threads', str(threads)], SCRIPT_DIR)
+
+
+# in run order
+STAGES = [
+    Stage('transrate', (),                      transrate_inputs, transrate_outputs, run_transrate, threads=transrate_threads),
+    Stage('scan',      ('transrate',),          scan_inputs,      scan_outputs,      run_scan,      threads=read_threads),
+    Stage('contigs',   ('transrate',),          contigs_inputs,   contigs_outputs,   run_contigs),
+    Stage('publish',   ('transrate', 'scan'),   publish_inputs,   publish_outputs,   run_publish,   fresh=False),
+    Stage('cache',     ('publish', 'contigs'),  cache_inputs,     cache_outputs,     run_cache,  True),
+    Stage('plots',     ('cache',),              plots_inputs,     plots_outputs,     run_plots,  True),
+]
+
+
+class Pipeline:
+    def __init__(self, root, output_dir, threads=1, job_threads=24, selected=None):
+        self.root        = os.path.abspath(root)
+        self.output_dir  = os.path.abspath(output_dir)
+        self.threads     = threads
+        self.job_threads = max(1, min(job_threads, threads))
+        self.read_bytes  = None
+        self.selected    = selected
+        self.index       = load_index(self.root)
+        # same ledger file transrate2's main.py writes, it runs with the root as its cwd
+        self.ledger      = Ledger(os.path.join(self.root, LEDGER_FILE))
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    # samples with an assembly, the only ones transrate2 can start from, and in the --samples/--types selection
+    def samples(self):
+        return [s for s, e in sorted(self.index.samples.items()) if e['assembly'] and registry.selected(s, self.selected)]
+
+    def command(self, cmd, cwd):
+        code = subprocess.run(cmd, cwd=cwd).returncode
+        if code != 0:
+            print(f"Warning: {' '.join(cmd)} exited with {code}")
+
+    # why a stage has to run for a sample, None if it's up to date
+    def reason(self, stage, sample, upstream, done):
+        if upstream:
+            return 'upstream changed'
+        if not all(os.path.exists(p) for p in stage.outputs(self, sample)):
+            return 'outputs missing'
+        old = done.get((sample, ORGANELLE))
+        if old is None:
+            return 'no record'
+        if old != fingerprint(stage.inputs(self, sample)):
+            return 'inputs changed'
+        return None
+
+    # stages are planned one at a time right before they run, so the later ones see the
+    # bams and files the earlier ones made. a dry run plans every stage as if it had run
+    def run(self, names, dry_run=False):
+        ran    = {}
+        failed = {}
+        for stage in STAGES:
+            if stage.name not in names:
+                continue
+            self.index.refresh()
+            upstream = set().union(*(ran.get(d, ()) for d in stage.deps))
+            # a sample whose inputs failed to build is left out, and counts as failed here too
+            blocked  = set().union(*(failed.get(d, ()) for d in stage.deps))
+            keys     = [AGGREGATE] if stage.aggregate else [s for s in self.samples() if s not in blocked]
+            failed[stage.name] = blocked - {AGGREGATE}
+            done     = self.ledger.fingerprints(f'pipeline.{stage.name}')
+            plan     = {}
+            for key in keys:
+                reason = self.reason(stage, key, bool(upstream) if stage.aggregate else key in upstream, done)
+                if reason:
+                    plan[key] = reason
+            ran[stage.name] = set(plan)
+
+            print(f"{stage.name:<12}{len(plan)} of {len(keys)} to run")
+            for key, reason in plan.items():
+                print(f"    {key:<12}{reason}")
+            if dry_run or not plan:
+                continue
+            failed[stage.name] |= self.execute(stage, sorted(plan), self.threads)
+        return set().union(*failed.values())
+
+    # runs one stage for some samples and records each of them in the ledger, returns the failed ones
+    def execute(self, stage, keys, threads):
+        start = time.time()
+        try:
+            # the stage's own subprocesses add their records to the same run
+            with profiling.stage(stage.name, keys[0] if len(keys) == 1 else None, unit='samples',
+                                 items=len(keys), threads=threads):
+                stage.run(self, keys, threads)
+        except Exception as e:
+            print(f"Warning: {stage.name} failed:\n{e!r}")
+        end    = time.time()
+        failed = set()
+        for key in keys:
+            ok = all(os.path.exists(p) and (not stage.fresh or os.path.getmtime(p) >= start)
+                     for p in stage.outputs(self, key))
+            self.ledger.record(key, ORGANELLE, f'pipeline.{stage.name}', 'done' if ok else 'failed',
+                               stage.inputs(self, key), start=start, end=end)
+            if not ok:
+                print(f"{stage.name:<12}{key} failed, outputs missing or not rewritten")
+                failed.add(key)
+        return failed
+
+    # a (stage, sample) is settled once all its upstream ones are: failed if one of them failed,
+    # up to date, or queued for the shared budget. the queue goes downstream stages first so a
+    # sample that's through transrate2 finishes instead of waiting behind the other samples,
+    # then the biggest jobs first. the aggregates run at the end with every core
+    def stream(self, names):
+        stages   = [s for s in STAGES if s.name in names and not s.aggregate]
+        selected = {s.name for s in stages}
+        rank     = {s.name: i for i, s in enumerate(stages)}
+        done     = {s.name: self.ledger.fingerprints(f'pipeline.{s.name}') for s in stages}
+        waiting  = [(stage, sample) for sample in self.samples() for stage in stages]
+        state    = {}
+        queue    = []
+        running  = {}
+        budget   = CoreBudget(self.threads)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while waiting or queue or running:
+                self.index.refresh()
+                settled = True
+                while settled:
+                    settled = False
+                    for stage, sample in list(waiting):
+                        deps = [state.get((d, sample)) for d in stage.deps if d in selected]
+                        if None in deps:
+                            continue
+                        waiting.remove((stage, sample))
+                        settled = True
+                        if 'failed' in deps:
+                            state[(stage.name, sample)] = 'failed'
+                            continue
+                        reason = self.reason(stage, sample, 'ran' in deps, done[stage.name])
+                        if reason is None:
+                            state[(stage.name, sample)] = 'fresh'
+                            continue
+                        threads = min(self.threads, stage.threads(self, sample)) if stage.threads else 1
+                        print(f"{stage.name:<12}{sample:<12}{reason}, {threads} threads")
+                        queue.append({'stage': stage, 'sample': sample, 'threads': threads})
+
+                queue.sort(key=lambda j: (-rank[j['stage'].name], -j['threads']))
+                while (job := budget.fit(queue)) is not None:
+                    running[executor.submit(self.execute, job['stage'], [job['sample']], job['threads'])] = job
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    budget.release(job['threads'])
+                    state[(job['stage'].name, job['sample'])] = 'failed' if future.result() else 'ran'
+
+        failed = {sample for (_, sample), st in state.items() if st == 'failed'}
+        ran    = {name for (name, _), st in state.items() if st == 'ran'}
+        counts = [sum(st == k for st in state.values()) for k in ('ran', 'fresh', 'failed')]
+        print(f"{counts[0]} sample jobs run, {counts[1]} up to date, {counts[2]} failed or blocked")
+        for stage in [s for s in STAGES if s.name in names and s.aggregate]:
+            upstream = any(d in ran for d in stage.deps)
+            reason   = self.reason(stage, AGGREGATE, upstream, self.ledger.fingerprints(f'pipeline.{stage.name}'))
+            if reason is None:
+                continue
+            print(f"{stage.name:<12}{AGGREGATE:<12}{reason}")
+            failed |= self.execute(stage, [AGGREGATE], self.threads)
+            ran.add(stage.name)
+        return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental pipeline from transrate2 to the figures')
+    parser.add_argument('--root',        default=REPO_DIR)                            # directory with the DAL*/WA* sample dirs
+    parser.add_argument('--output-dir',  default=os.path.join(SCRIPT_DIR, '01_plots'))
+    parser.add_argument('--stages',      default=','.join(s.name for s in STAGES))
+    parser.add_argument('--threads',     type=int, default=os.cpu_count() or 1)       # cores shared by every job
+    parser.add_argument('--job-threads', type=int, default=24)                        # most a single sample's job gets
+    parser.add_argument('--barrier',     action='store_true')                         # every sample through a stage before the next
+    parser.add_argument('--dry-run',     action='store_true')                         # only print what would run and why
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('pipeline', args)
+
+    names = [n for n in args.stages.split(',') if n in {s.name for s in STAGES}]
+    pipe  = Pipeline(args.root, args.output_dir, args.threads, args.job_threads, registry.selection(args))
+    if args.dry_run or args.barrier:
+        failed = pipe.run(names, dry_run=args.dry_run)
+    else:
+        failed = pipe.stream(names)
+    pipe.ledger.close()
+    if failed:
+        print(f"{len(failed)} failed: {', '.join(sorted(failed))}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,65 @@
 import os
 import re
+import json
+import types
+import hashlib
+import inspect
+import importlib
 import pickle
+import io
+import queue
 import multiprocessing as mp
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+from multiprocessing import util
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-import pandas as pd
+import constants
+import profiling
 from constants import *
-from matplotlib.patches import Patch
+from registry import selected
 
+
+# matplotlib and pandas take most of the startup time, so they're only imported the first time
+# something actually draws or parses. a run where every figure is up to date never loads them
+class LazyModule:
+    def __init__(self, name):
+        self._name   = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            if self._name.startswith('matplotlib'):
+                import matplotlib
+                matplotlib.use('Agg')
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+plt          = LazyModule('matplotlib.pyplot')
+mpimg        = LazyModule('matplotlib.image')
+gridspec     = LazyModule('matplotlib.gridspec')
+mpatches     = LazyModule('matplotlib.patches')
+mcollections = LazyModule('matplotlib.collections')
+pd           = LazyModule('pandas')
+
+
+# loaded once in the parent before the render pool forks, so the workers don't each import them
+def import_render_modules():
+    for module in (plt, mpimg, gridspec, mpatches, mcollections):
+        module.load()
+
+# the manifest's type, the display name suffix only for samples outside it (bench_plots' synthetic ones)
 def sample_type(sample):
+    if sample in SAMPLE_TYPES:
+        return SAMPLE_TYPES[sample]
     name = SAMPLE_NAMES.get(sample, '')
     if '-' in name:
         suffix = name.split('-', 1)[1]
         return {'Silica': 'silica', 'Fresh': 'fresh', 'Herbarium': 'herbaria'}.get(suffix, 'unknown')
-    return SAMPLE_TYPES.get(sample, 'unknown')
+    return 'unknown'
 
 
 def display_name(sample):
@@ -30,6 +73,14 @@ def display_name(sample):
 
 CACHE = None
 
+# outputs/inputs/code are only used for the render keys. inputs are (sample, cache key) pairs,
+# sample None being one of the cross sample aggregates. code defaults to (fn,)
+FigureJob = namedtuple('FigureJob', ['name', 'fn', 'args', 'weight', 'outputs', 'inputs', 'code'],
+                       defaults=[1, (), (), None])
+
+RENDER_KEYS        = '.render_keys.json'
+MATPLOTLIB_VERSION = None
+
 
 def parse_busco(path):
     content = open(path).read()
@@ -53,20 +104,22 @@ def parse_busco(path):
     return data
 
 
+# counts per (End, Pos) summed over every reference and both strands. mapDamage writes a block of
+# rows per Chr and scan.py a single merged one, both come out the same. store.py uses it too so
+# the cache from results.sqlite matches the one parsed from the files
+def deamination_totals(df):
+    return df.drop(columns=['Chr', 'Std'], errors='ignore').groupby(['End', 'Pos']).sum()
+
+
+# substitution frequency at positions 1..25 from each end
 def parse_deamination(path):
-    df = pd.read_csv(path, sep='\t')
-    raw = {}
-    for end in ('3p', '5p'):
-        for std in ('+', '-'):
-            sub = df[(df['End'] == end) & (df['Std'] == std)]
-            for col in ('C>T', 'A>G', 'Total'):
-                vals = sub[col].head(25).tolist() if col in sub.columns else []
-                raw[(end, std, col)] = vals + [0] * (25 - len(vals))
+    totals = deamination_totals(pd.read_csv(path, sep='\t'))
 
     def combine(end, col):
-        p, n   = raw[(end, '+', col)],     raw[(end, '-', col)]
-        pt, nt = raw[(end, '+', 'Total')], raw[(end, '-', 'Total')]
-        return [(a+b)/(c+d) if (c+d) > 0 else 0 for a, b, c, d in zip(p, n, pt, nt)]
+        if col not in totals.columns or end not in totals.index.get_level_values('End'):
+            return [0] * 25
+        sub = totals.xs(end, level='End').reindex(range(1, 26), fill_value=0)
+        return [c / t if t > 0 else 0 for c, t in zip(sub[col], sub['Total'])]
 
     c3t = combine('3p', 'C>T'); c3t.reverse()
     a3g = combine('3p', 'A>G'); a3g.reverse()
@@ -74,14 +127,22 @@ def parse_deamination(path):
             '3p_CtoT': c3t, '3p_AtoG': a3g}
 
 
+# 0 is end to end and less than 0 is an overlap.
+# the data also fell off before 800 so no point in plotting all of it
+INSERT_MAX    = 800
+INSERTS_CHUNK = 1_000_000
+
+
+# only the insert_length column is read, a chunk at a time, into a fixed bincount so memory
+# doesn't grow with the csv. gives the same x/y lists the old value_counts version did
 def parse_inserts(path):
-    df     = pd.read_csv(path)
-    counts = df[df['insert_length'] >= 1]['insert_length'].value_counts().sort_index()
-    x, y   = counts.index.values, counts.values
-    # 0 is end to end and less than 0 is an overlap.
-    # the data also fell off before 800 so no point in plotting all of it
-    mask   = (x >= 1) & (x <= 800)
-    return {'x': x[mask].tolist(), 'y': y[mask].tolist()}
+    counts = np.zeros(INSERT_MAX + 1, dtype=np.int64)
+    for chunk in pd.read_csv(path, usecols=['insert_length'], chunksize=INSERTS_CHUNK):
+        lengths = chunk['insert_length'].to_numpy()
+        lengths = lengths[(lengths >= 1) & (lengths <= INSERT_MAX)]
+        counts += np.bincount(lengths.astype(np.int64), minlength=INSERT_MAX + 1)
+    x = np.flatnonzero(counts)
+    return {'x': x.tolist(), 'y': counts[x].tolist()}
 
 
 def parse_transrate(path):
@@ -89,54 +150,294 @@ def parse_transrate(path):
     return [float(df[c].iloc[0]) if c in df.columns else 0.0 for c in TRANSRATE_COLS]
 
 
+# compact histogram/quantile summary written by 03_transrate/contig_stats.py
+def parse_transrate_contigs(path):
+    with open(path) as f:
+        summary = json.load(f)
+    return {'edges'    : summary['edges'],
+            'contigs'  : summary['contigs'],
+            'counts'   : {c: s['counts'] for c, s in summary['scores'].items()},
+            'quantiles': {c: s['quantiles'] for c, s in summary['scores'].items()}}
+
+
+# busco and the inserts csv go by the manifest's file stem
 def busco_path(sample):
-    suffix = '_paired' if sample.startswith('WA') else ''
-    name = f'{sample}{suffix}_busco'
+    name = f'{SAMPLES.get(sample, sample)}_busco'
     return os.path.join(DATA_DIR, 'busco', name, f'short_summary.specific.viridiplantae_odb10.{name}.txt')
 
 
 def inserts_path(sample):
-    suffix = '_paired' if sample.startswith('WA') else ''
-    return os.path.join(DATA_DIR, 'inserts', f'{sample}{suffix}.csv')
+    return os.path.join(DATA_DIR, 'inserts', f'{SAMPLES.get(sample, sample)}.csv')
+
+
+# a path column in the manifest overrides where a file is read from
+def sample_sources(sample):
+    sources = {
+        'busco':       (busco_path(sample), parse_busco),
+        'deamination': (os.path.join(DATA_DIR, 'deamination', sample, 'misincorporation.txt'), parse_deamination),
+        'inserts':     (inserts_path(sample), parse_inserts),
+        'transrate':   (os.path.join(DATA_DIR, 'transrate', f'{sample}.csv'), parse_transrate),
+        'transrate_contigs': (os.path.join(DATA_DIR, 'transrate_contigs', f'{sample}.json'), parse_transrate_contigs),
+    }
+    return {key: (REGISTRY.path(sample, key) or path, fn) for key, (path, fn) in sources.items()}
+
+
+# path, size and mtime of the file an entry was parsed from. None if it's gone
+def fingerprint(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def parse_entry(args):
+    sample, key = args
+    path, fn    = sample_sources(sample)[key]
+    try:
+        with profiling.stage(f'parse:{key}', sample):
+            return sample, key, fn(path)
+    except Exception as e:
+        print(f"Warning: {key} parse failed for {sample}:\n{e}")
+        return sample, key, None
+
+
+# the cache is a directory of .npy files, one per (sample, data type), plus index.json
+# with the fingerprints, small per entry metadata and the cross sample aggregates.
+# entries are memory mapped read only on first use, so a plot worker only ever
+# touches the samples it draws and start up is just reading index.json.
+BUSCO_FIELDS = ['S', 'D', 'F', 'M', 'S_count', 'D_count', 'F_count', 'M_count']
+DEAM_CURVES  = ['5p_CtoT', '5p_AtoG', '3p_CtoT', '3p_AtoG']
+
+
+def encode_entry(key, data):
+    if key == 'busco':
+        return np.array([data.get(f, np.nan) for f in BUSCO_FIELDS], dtype=np.float64), {}
+    if key == 'deamination':
+        return np.array([data[c] for c in DEAM_CURVES], dtype=np.float64), {}
+    if key == 'inserts':
+        arr = np.array([data['x'], data['y']], dtype=np.int64).reshape(2, -1)
+        return arr, {'max_y': int(arr[1].max()) if arr.shape[1] else 0}
+    if key == 'transrate':
+        return np.asarray(data, dtype=np.float64), {}
+    if key == 'transrate_contigs':
+        cols = list(data['counts'])
+        arr  = np.array([data['counts'][c] for c in cols], dtype=np.int64)
+        return arr, {'cols': cols, 'edges': list(data['edges']), 'contigs': data['contigs'],
+                     'quantiles': data['quantiles']}
+    raise KeyError(key)
+
+
+def decode_entry(key, arr, meta):
+    if key == 'busco':
+        return {f: (int(v) if f.endswith('_count') else float(v)) for f, v in zip(BUSCO_FIELDS, arr) if not np.isnan(v)}
+    if key == 'deamination':
+        return dict(zip(DEAM_CURVES, arr))
+    if key == 'inserts':
+        return {'x': arr[0], 'y': arr[1]}
+    if key == 'transrate':
+        return arr.tolist()
+    if key == 'transrate_contigs':
+        return {'edges': meta['edges'], 'contigs': meta['contigs'], 'quantiles': meta['quantiles'],
+                'counts': dict(zip(meta['cols'], arr))}
+    raise KeyError(key)
+
+
+def entry_path(sample, key):
+    return os.path.join(CACHE_DIR, sample, f'{key}.npy')
+
+
+def load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # empty arrays can't be mapped
+        return np.load(path)
+
+
+class SampleEntry:
+    def __init__(self, sample, meta):
+        self.sample = sample
+        self.meta   = meta
+        self.loaded = {}
+
+    def __contains__(self, key):
+        return key in self.meta
+
+    def __getitem__(self, key):
+        if key not in self.meta:
+            raise KeyError(key)
+        if key not in self.loaded:
+            self.loaded[key] = decode_entry(key, load_array(entry_path(self.sample, key)), self.meta[key])
+        return self.loaded[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self.meta else default
+
+    def keys(self):
+        return self.meta.keys()
+
+
+class ArrayCache:
+    def __init__(self, index):
+        self.index   = index
+        self.entries = {}
+        self.changed = []
+
+    def __contains__(self, sample):
+        return sample in self.index['samples'] or sample == 'inserts_y'
+
+    def __getitem__(self, sample):
+        if sample == 'inserts_y':
+            return self.index['aggregates']['inserts_y']
+        if sample not in self.index['samples']:
+            raise KeyError(sample)
+        if sample not in self.entries:
+            self.entries[sample] = SampleEntry(sample, self.index['samples'][sample])
+        return self.entries[sample]
+
+    def get(self, sample, default=None):
+        return self[sample] if sample in self else default
+
+    def keys(self):
+        return self.index['samples'].keys()
+
+
+def empty_index():
+    return {'samples': {}, 'fingerprints': {}, 'aggregates': {'inserts_y': {'max_inserts_y': 0.0}}}
+
+
+def read_index():
+    path = os.path.join(CACHE_DIR, 'index.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def write_index(index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, 'index.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{path}.tmp', path)
+
 
+def write_entry(index, sample, key, data):
+    arr, meta = encode_entry(key, data)
+    path      = entry_path(sample, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        np.save(f, arr)
+    os.replace(f'{path}.tmp', path)
+    index['samples'].setdefault(sample, {})[key] = meta
 
-# create a pickle of all the data needed. So that rerunning this for edits was faster than rescanning all the data
-def build_cache():
-    print("Building cache")
-    cache = {}
+
+def drop_entry(index, sample, key):
+    index['samples'].get(sample, {}).pop(key, None)
+    index['fingerprints'].get(sample, {}).pop(key, None)
+    if os.path.exists(entry_path(sample, key)):
+        os.remove(entry_path(sample, key))
+
+
+# anything computed across samples, always redone from the per entry metadata
+def update_aggregates(index):
+    max_y = max((index['samples'][s]['inserts']['max_y'] for s in SAMPLES
+                 if 'inserts' in index['samples'].get(s, {})), default=0.0)
+    index['aggregates'] = {'inserts_y': {'max_inserts_y': max_y * 1.1}}
+
+
+# one time conversion of the old pickled dict cache
+def migrate_pickle():
+    with open(CACHE_FILE, 'rb') as f:
+        old = pickle.load(f)
+    print(f"Converting {CACHE_FILE} to {CACHE_DIR}")
+    index = empty_index()
     for sample in SAMPLES:
-        entry = {}
-        parsers = {
-            'busco':       (busco_path(sample), parse_busco),
-            'deamination': (os.path.join(DATA_DIR, 'deamination', sample, 'misincorporation.txt'), parse_deamination),
-            'inserts':     (inserts_path(sample), parse_inserts),
-            'transrate':   (os.path.join(DATA_DIR, 'transrate', f'{sample}.csv'), parse_transrate),
-        }
-        for key, (path, fn) in parsers.items():
-            if os.path.exists(path):
-                try:
-                    entry[key] = fn(path)
-                except Exception as e:
-                    print(f"Warning: {key} parse failed for {sample}:\n{e}")
-            else:
-                print(f"Warning: {key} file not found for {sample}")
-        cache[sample] = entry
-
-    max_y = max((max(e['inserts']['y']) for e in cache.values()
-                 if e.get('inserts') and e['inserts']['y']), default=0.0)
-    cache['inserts_y'] = {'max_inserts_y': max_y * 1.1}
-
-    with open(CACHE_FILE, 'wb') as f:
-        pickle.dump(cache, f)
-    print(f"Cache written: {CACHE_FILE}")
+        for key, data in old.get(sample, {}).items():
+            write_entry(index, sample, key, data)
+    for (sample, key), fp in old.get('_fingerprints', {}).items():
+        if key in index['samples'].get(sample, {}):
+            index['fingerprints'].setdefault(sample, {})[key] = list(fp)
+    update_aggregates(index)
+    write_index(index)
+    return index
+
+
+# create a cache of all the data needed. So that rerunning this for edits was faster than rescanning all the data
+# entries are per (sample, data type) and only reparsed when their source file changed.
+# samples limits it to a --samples/--types selection, the other samples' entries are left as they are
+def build_cache(from_store=False, full=False, workers=None, samples=None):
+    print("Building cache")
+    index = (None if full and samples is None else read_index()) or empty_index()
+    if from_store:
+        # store.py already did the parsing, this is just a read of results.sqlite
+        from store import load_entries
+        entries = load_entries()
+        index   = empty_index() if samples is None else index
+        changed = []
+        for sample in [s for s in SAMPLES if selected(s, samples)]:
+            for key in set(index['samples'].get(sample, {})) - set(entries.get(sample, {})):
+                drop_entry(index, sample, key)
+            for key, data in entries.get(sample, {}).items():
+                write_entry(index, sample, key, data)
+                changed.append((sample, key))
+    else:
+        old_fps = index['fingerprints']
+        new_fps = {}
+        stale   = []
+        for sample in SAMPLES:
+            if not selected(sample, samples):
+                if sample in old_fps:
+                    new_fps[sample] = old_fps[sample]
+                continue
+            for key, (path, _) in sample_sources(sample).items():
+                fp = fingerprint(path)
+                if fp is None:
+                    print(f"Warning: {key} file not found for {sample}")
+                    drop_entry(index, sample, key)
+                    continue
+                new_fps.setdefault(sample, {})[key] = list(fp)
+                if full or old_fps.get(sample, {}).get(key) != list(fp) or key not in index['samples'].get(sample, {}):
+                    stale.append((sample, key))
+        for sample in [s for s in index['samples'] if s not in SAMPLES]:
+            for key in list(index['samples'][sample]):
+                drop_entry(index, sample, key)
+            del index['samples'][sample]
+
+        if stale:
+            print(f"Parsing {len(stale)} stale entries")
+            workers = max(1, min(workers or os.cpu_count() or 1, len(stale)))
+            # a single stale entry (the usual case in --watch) isn't worth starting a pool for
+            pool    = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+            try:
+                for sample, key, data in (pool.map if pool else map)(parse_entry, stale):
+                    if data is None:
+                        drop_entry(index, sample, key)
+                        new_fps.get(sample, {}).pop(key, None)
+                    else:
+                        write_entry(index, sample, key, data)
+            finally:
+                if pool:
+                    pool.shutdown()
+        index['fingerprints'] = new_fps
+        changed = stale
+
+    update_aggregates(index)
+    write_index(index)
+    print(f"Cache written: {CACHE_DIR} ({len(changed)} entries rebuilt)")
+    cache = ArrayCache(index)
+    cache.changed = changed
     return cache
 
 
 def load_cache():
-    if os.path.exists(CACHE_FILE):
+    index = read_index()
+    if index is None and os.path.exists(CACHE_FILE):
+        index = migrate_pickle()
+    if index is not None:
         print(f"Loading from cache")
-        with open(CACHE_FILE, 'rb') as f:
-            return pickle.load(f)
+        return ArrayCache(index)
     return build_cache()
 
 
@@ -262,7 +563,7 @@ def draw_deamination(ax, sample, fonts, title=None, show_ylabel=True, show_legen
 def draw_inserts(ax, sample, max_y, fonts, title=None, show_ylabel=True, linewidth=2, **_):
     data = get_cache().get(sample, {}).get('inserts')
 
-    if data['x']:
+    if len(data['x']):
         ax.plot(data['x'], data['y'], color='#000000', linewidth=linewidth)
 
     ax.set_title(title or display_name(sample), fontsize=fonts['title'], fontweight='bold', pad=fonts['title_pad'])
@@ -297,6 +598,34 @@ def draw_transrate(ax, sample, fonts, title=None, show_ylabel=True, **_):
     ax.grid(True, alpha=0.3, axis='y')
 
 
+def draw_transrate_contigs(ax, sample, fonts, title=None, show_ylabel=True, show_legend=True, linewidth=2, **_):
+    data    = get_cache().get(sample, {}).get('transrate_contigs')
+    edges   = np.asarray(data['edges'])
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    for col, label, color_col in zip(CONTIG_SCORE_COLS, TRANSRATE_LABELS, TRANSRATE_COLS):
+        counts = np.asarray(data['counts'].get(col, []), dtype=float)
+        if not counts.sum():
+            continue
+        ax.plot(centers, counts / counts.sum(), color=COLORS['transrate'][color_col], label=label,
+                linewidth=linewidth, alpha=0.8)
+        median = data['quantiles'][col].get('0.5')
+        if median is not None:
+            ax.axvline(x=median, color=COLORS['transrate'][color_col], linestyle='--', linewidth=linewidth / 2, alpha=0.6)
+
+    ax.set_title(title or display_name(sample), fontsize=fonts['title'], fontweight='bold', pad=fonts['title_pad'])
+    ax.set_xlim(0, 1)
+    ax.set_ylim(bottom=0)
+    ax.tick_params(axis='x', labelsize=fonts['tick_label'], pad=8)
+    ax.tick_params(axis='y', labelsize=fonts['tick_label'], pad=8)
+    ax.set_xlabel('Contig Score', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+    if show_ylabel:
+        ax.set_ylabel('Fraction of Contigs', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+    if show_legend:
+        ax.legend(fontsize=fonts['legend'], loc='upper right', framealpha=0.95)
+    ax.grid(True, alpha=0.3)
+
+
 def draw_transrate_score(ax, score_col, score_label, fonts, show_ylabel=True, **_):
     score_idx = TRANSRATE_COLS.index(score_col)
     cache     = get_cache()
@@ -329,7 +658,7 @@ def draw_transrate_all(ax, score_col, score_label, fonts, show_ylabel=True):
 
     for s in SAMPLES:
         scores = cache.get(s, {}).get('transrate')
-        if scores:
+        if scores is not None:
             groups[sample_type(s)].append((s, scores[score_idx]))
     for t in TYPE_ORDER:
         groups[t].sort(key=lambda x: x[1])
@@ -376,6 +705,74 @@ def draw_4col(fig, gs, row_idx, items, draw_fn, fonts):
     return first_ax
 
 
+# when a figure also goes out as svg/pdf its pngs are rasterised first and only the compression and
+# write go to a small thread pool per process, so zlib overlaps with drawing the vector output.
+# a figure that's only a png has nothing to overlap with and is encoded in place.
+# run_job waits for a job's writes before it reports back, anything saved outside a job is
+# flushed when the process exits
+ENCODER = None
+PENDING = []
+
+
+def encoder():
+    global ENCODER
+    if ENCODER is None or ENCODER[0] != os.getpid():
+        ENCODER = (os.getpid(), ThreadPoolExecutor(max_workers=ENCODE_THREADS))
+        PENDING.clear()
+        util.Finalize(None, flush_encoder, exitpriority=10)
+    return ENCODER[1]
+
+
+def encode_png(path, rgba, dpi):
+    mpimg.imsave(f'{path}.tmp', rgba, format='png', dpi=dpi)
+    os.replace(f'{path}.tmp', path)
+
+
+def flush_encoder():
+    failed = []
+    while PENDING:
+        path, future = PENDING.pop()
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Warning: writing {path} failed:\n{e}")
+            failed.append(path)
+    return failed
+
+
+# lines with more points than DENSE_LINE_POINTS are drawn as an image inside vector output
+def rasterize_dense_lines(fig):
+    for ax in fig.axes:
+        for line in ax.lines:
+            if len(line.get_xdata()) > DENSE_LINE_POINTS:
+                line.set_rasterized(True)
+
+
+# one save for any number of formats. with more than one the tight bbox is worked out once
+# and reused, otherwise each savefig redoes the layout pass to find it. pngs go first so their
+# encoding runs while the vector outputs are drawn
+def save_figure(fig, paths, dpi='figure', rasterize=False):
+    png_dpi = fig.dpi if dpi == 'figure' else dpi
+    bbox    = 'tight'
+    pngs    = [p for p in paths if p.endswith('.png')]
+    vectors = [p for p in paths if not p.endswith('.png')]
+    if len(paths) > 1:
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+    for path in pngs:
+        buf = io.BytesIO()
+        fig.savefig(buf, format='rgba', dpi=png_dpi, bbox_inches=bbox)
+        r    = fig.canvas.renderer
+        rgba = np.frombuffer(buf.getbuffer(), dtype=np.uint8).reshape(int(r.height), int(r.width), 4)
+        if vectors:
+            PENDING.append((path, encoder().submit(encode_png, path, rgba, png_dpi)))
+        else:
+            encode_png(path, rgba, png_dpi)
+    for path in vectors:
+        if rasterize:
+            rasterize_dense_lines(fig)
+        fig.savefig(path, dpi=dpi, bbox_inches=bbox)
+
+
 # the 4 plots of the 3 rep samples
 def plot_rep(plot_type, output_dir):
     print(f"{plot_type.capitalize():<12} - representative")
@@ -385,12 +782,13 @@ def plot_rep(plot_type, output_dir):
     max_y = get_cache()['inserts_y']['max_inserts_y'] if plot_type == 'inserts' else None
     fig, axes = plt.subplots(1, 3, figsize=FIGSIZE_REP, sharey=True)
 
-    lw = 8 if plot_type in ('deamination', 'inserts') else 2
+    lw = 8 if plot_type in ('deamination', 'inserts', 'transrate_contigs') else 2
     draw_fn = {
         'busco'      : lambda ax, s, i: draw_busco(ax, s, FONTS_CONCAT, show_ylabel=(i==0)),
         'deamination': lambda ax, s, i: draw_deamination(ax, s, FONTS_CONCAT, show_ylabel=(i==0), show_legend=(i==0), linewidth=lw),
         'inserts'    : lambda ax, s, i: draw_inserts(ax, s, max_y, FONTS_CONCAT, show_ylabel=(i==0), linewidth=lw),
         'transrate'  : lambda ax, s, i: draw_transrate(ax, s, FONTS_CONCAT, show_ylabel=(i==0)),
+        'transrate_contigs': lambda ax, s, i: draw_transrate_contigs(ax, s, FONTS_CONCAT, show_ylabel=(i==0), show_legend=(i==0), linewidth=lw),
     }[plot_type]
 
     for i, sample in enumerate(REPRESENTATIVE_SAMPLES):
@@ -400,8 +798,8 @@ def plot_rep(plot_type, output_dir):
             plt.setp(axes[1].get_yticklabels(), visible=False)
 
     plt.tight_layout(pad=8.0, h_pad=4.0, w_pad=3.0)
-    plt.savefig(os.path.join(sub_dir, f'{plot_type}_representative.png'), dpi=300, bbox_inches='tight')
-    plt.close()
+    save_figure(fig, [os.path.join(sub_dir, f'{plot_type}_representative.png')], dpi=300)
+    plt.close(fig)
 
 # transrate needed its own function because it has one that is all the individuals combined
 # and this is a seperate one thats grouped by score type. snuc scov etc 
@@ -416,16 +814,16 @@ def plot_transrate_scores(output_dir):
         draw_transrate_all(ax, col, label, FONTS_IND)
 
     legend_patches = [
-        Patch(facecolor=COLORS['fresh'],    alpha=0.85, label='Fresh'),
-        Patch(facecolor=COLORS['silica'],   alpha=0.85, label='Silica'),
-        Patch(facecolor=COLORS['herbaria'], alpha=0.85, label='Herbarium'),
+        mpatches.Patch(facecolor=COLORS['fresh'],    alpha=0.85, label='Fresh'),
+        mpatches.Patch(facecolor=COLORS['silica'],   alpha=0.85, label='Silica'),
+        mpatches.Patch(facecolor=COLORS['herbaria'], alpha=0.85, label='Herbarium'),
     ]
     fig.legend(handles=legend_patches, fontsize=FONTS_IND['legend'],
                loc='upper center', ncol=3, framealpha=0.8, bbox_to_anchor=(0.5, 1.01))
 
     plt.tight_layout(pad=2.5)
-    plt.savefig(os.path.join(sub_dir, 'transrate_scores.png'), dpi=300, bbox_inches='tight')
-    plt.close()
+    save_figure(fig, [os.path.join(sub_dir, 'transrate_scores.png')], dpi=300)
+    plt.close(fig)
 
 def plot_busco_categories(output_dir):
 
@@ -438,20 +836,95 @@ def plot_busco_categories(output_dir):
         draw_busco_all(ax, cat, label.replace('\n', ' '), FONTS_IND)
 
     legend_patches = [
-        Patch(facecolor=COLORS['fresh'],    alpha=0.85, label='Fresh'),
-        Patch(facecolor=COLORS['silica'],   alpha=0.85, label='Silica'),
-        Patch(facecolor=COLORS['herbaria'], alpha=0.85, label='Herbarium'),
+        mpatches.Patch(facecolor=COLORS['fresh'],    alpha=0.85, label='Fresh'),
+        mpatches.Patch(facecolor=COLORS['silica'],   alpha=0.85, label='Silica'),
+        mpatches.Patch(facecolor=COLORS['herbaria'], alpha=0.85, label='Herbarium'),
     ]
     fig.legend(handles=legend_patches, fontsize=FONTS_IND['legend'],
                loc='upper center', ncol=3, framealpha=0.8, bbox_to_anchor=(0.5, 1.01))
 
     plt.tight_layout(pad=2.5)
-    plt.savefig(os.path.join(sub_dir, 'busco_categories.png'), dpi=300, bbox_inches='tight')
-    plt.close()
+    save_figure(fig, [os.path.join(sub_dir, 'busco_categories.png')], dpi=300)
+    plt.close(fig)
+
+
+# every sample's curve as rows of one matrix. inserts are normalised to the fraction of inserts
+# at each length so samples sequenced to different depths sit on the same axis. deamination is
+# the C>U curve, 5' end then 3' end, as two pieces of 25
+def overlay_matrix(plot_type, samples):
+    cache = get_cache()
+    if plot_type == 'inserts':
+        x, Y = np.arange(1, INSERT_MAX + 1), np.zeros((len(samples), INSERT_MAX))
+        for i, s in enumerate(samples):
+            data = cache.get(s, {}).get('inserts')
+            if data is not None and len(data['x']):
+                Y[i, np.asarray(data['x']) - 1] = data['y']
+        # samples without any inserts are left out, like the missing deamination ones below
+        totals = Y.sum(axis=1)
+        keep   = totals > 0
+        return [(x, Y[keep] / totals[keep, None])]
+    rows = [cache.get(s, {}).get('deamination') for s in samples]
+    rows = [r for r in rows if r is not None]
+    return [(np.arange(1, 26),   np.array([r['5p_CtoT'] for r in rows]).reshape(len(rows), 25)),
+            (np.arange(-25, 0),  np.array([r['3p_CtoT'] for r in rows]).reshape(len(rows), 25))]
+
+
+# one LineCollection per type and piece however many samples there are, so the draw cost
+# barely moves with the sample count. alpha drops as the lines pile up
+def draw_overlay(ax, plot_type, fonts, ribbons=True):
+    samples = [s for s in SAMPLES if sample_type(s) in TYPE_ORDER]
+    for t in TYPE_ORDER:
+        group = [s for s in samples if sample_type(s) == t]
+        if not group:
+            continue
+        alpha = float(np.clip(8 / len(group), 0.05, 0.6))
+        for x, Y in overlay_matrix(plot_type, group):
+            if not len(Y):
+                continue
+            segments = np.stack([np.broadcast_to(x, Y.shape), Y], axis=-1)
+            ax.add_collection(mcollections.LineCollection(segments, colors=COLORS[t], linewidths=0.8, alpha=alpha, zorder=2))
+            if ribbons:
+                lo, mid, hi = np.quantile(Y, OVERLAY_QUANTILES, axis=0)
+                ax.fill_between(x, lo, hi, color=COLORS[t], alpha=0.3, linewidth=0, zorder=3)
+                ax.plot(x, mid, color=COLORS[t], linewidth=3, zorder=4)
+                # dark edge so the median stands out of its own lines
+                ax.plot(x, mid, color='#000000', linewidth=0.8, zorder=5)
+
+    ax.autoscale_view()
+    ax.set_ylim(bottom=0)
+    if plot_type == 'inserts':
+        ax.set_xlim(1, INSERT_MAX)
+        ax.set_xlabel('Insert Length (bp)', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+        ax.set_ylabel('Fraction of Inserts', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+        ax.set_title('Insert Length, All Samples', fontsize=fonts['title'], fontweight='bold', pad=fonts['title_pad'])
+    else:
+        ax.set_xlim(-25.5, 25.5)
+        ax.set_xticks([-25, -20, -15, -10, -5, -1, 1, 5, 10, 15, 20, 25])
+        ax.set_xticklabels(['1', '', '', '15', '', '', '', '', '-15', '', '', '-1'])
+        ax.set_xlabel('Position', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+        ax.set_ylabel('C>U Misincorporation Frequency', fontsize=fonts['axis_label'], labelpad=fonts['labelpad'])
+        ax.set_title('Deamination, All Samples', fontsize=fonts['title'], fontweight='bold', pad=fonts['title_pad'])
+    ax.tick_params(axis='both', labelsize=fonts['tick_label'], pad=8)
+    ax.grid(True, alpha=0.3, zorder=0)
+
+
+def plot_overlay(plot_type, output_dir, ribbons=True):
+    print(f"{plot_type.capitalize():<12} - overlay")
+    sub_dir = os.path.join(output_dir, plot_type)
+    os.makedirs(sub_dir, exist_ok=True)
+
+    fig, ax = plt.subplots(1, 1, figsize=FIGSIZE_OVERLAY)
+    draw_overlay(ax, plot_type, FONTS_IND, ribbons)
+    legend_patches = [mpatches.Patch(facecolor=COLORS[t], alpha=0.85, label=TYPE_DISPLAY[t]) for t in TYPE_ORDER]
+    ax.legend(handles=legend_patches, fontsize=FONTS_IND['legend'], loc='upper right', framealpha=0.95)
+
+    plt.tight_layout()
+    save_figure(fig, [os.path.join(sub_dir, f'{plot_type}_overlay.png')], dpi=300)
+    plt.close(fig)
 
 
 # this is figure 2 (i think 2?) with all of the rep plots in 4 rows.
-def concat_rep(output_dir, plot_types):
+def concat_rep(output_dir, plot_types, rasterize=False):
     print("Concatenated Representative Plots")
     ordered = [pt for pt in CONCAT_PLOT_ORDER if pt in plot_types]
     if len(ordered) < 2:
@@ -493,39 +966,123 @@ def concat_rep(output_dir, plot_types):
         fig.text(0.03, pos.y1 + 0.005, chr(65 + row_idx), fontsize=FONT_ROW_LABEL, fontweight='bold', ha='center', va='top')
         fig.text(pos.x0 - 0.09, pos.y0 + (pos.y1 - pos.y0) / 2, ROW_TITLES[plot_type], fontsize=FONT_ROW_TITLE, fontweight='bold', ha='center', va='center', rotation=90)
 
-    plt.savefig(os.path.join(output_dir, 'representative_plots_concatenated.svg'), format='svg', bbox_inches='tight')
-    plt.savefig(os.path.join(output_dir, 'representative_plots_concatenated.png'), format='png', bbox_inches='tight')
-    plt.close()
+    save_figure(fig, [os.path.join(output_dir, f'representative_plots_concatenated.{ext}') for ext in ('svg', 'png')],
+                rasterize=rasterize)
+    plt.close(fig)
 
 
-# individual thread/worker for individual plots, based on how many threads wanted
-def individual_worker(args):
-    plot_type, sample, output_dir, max_y = args
-    cache   = get_cache()
+INDIVIDUAL_DRAW = {
+    'busco'            : draw_busco,
+    'deamination'      : draw_deamination,
+    'inserts'          : draw_inserts,
+    'transrate'        : draw_transrate,
+    'transrate_contigs': draw_transrate_contigs,
+}
+
+
+def individual_figure(plot_type, sample, max_y):
     fig, ax = plt.subplots(1, 1, figsize=FIGSIZE[plot_type])
     title   = f'{display_name(sample)}{TITLE_SUFFIX[plot_type]}'
+    INDIVIDUAL_DRAW[plot_type](ax, sample, fonts=FONTS_IND, title=title, max_y=max_y)
+    plt.tight_layout()
+    return fig, ax
 
-    if plot_type == 'busco':
-        draw_busco(ax, sample, FONTS_IND, title=title)
-    elif plot_type == 'deamination':
-        draw_deamination(ax, sample, FONTS_IND, title=title)
-    elif plot_type == 'inserts':
-        draw_inserts(ax, sample, max_y, FONTS_IND, title=title)
-    elif plot_type == 'transrate':
-        draw_transrate(ax, sample, FONTS_IND, title=title)
 
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, plot_type, 'individual', f'{plot_type}_{sample}.png'), dpi=300, bbox_inches='tight')
-    plt.close()
+# individual thread/worker for individual plots, based on how many threads wanted
+def individual_worker(args):
+    plot_type, sample, output_dir, max_y = args
+    fig, ax = individual_figure(plot_type, sample, max_y)
+    save_figure(fig, [os.path.join(output_dir, plot_type, 'individual', f'{plot_type}_{sample}.png')], dpi=300)
+    plt.close(fig)
     return
 
 
-# makes a powerpoint slide of all the individual plots concatenated together
-def plot_all_samples(plot_type, output_dir):
-    print(f"{plot_type.capitalize():<12} - all samples")
+# template mode. each worker draws the first sample of a type normally and keeps that figure,
+# every later sample only swaps the data, bar labels and title on it before saving.
+# an update returns False when the template can't take the sample and it gets drawn from scratch
+TEMPLATES = {}
+
+
+def update_bars(ax, values, offset, fmt):
+    if len(ax.patches) != len(values) or len(ax.texts) != len(values):
+        return False
+    for bar, text, value in zip(ax.patches, ax.texts, values):
+        bar.set_height(value)
+        text.set_y(value + offset)
+        text.set_text(fmt.format(value))
+
+
+def update_busco(ax, sample):
+    data = get_cache().get(sample, {}).get('busco')
+    return update_bars(ax, [data[k] for k in BUSCO_CATEGORIES], 1.5, '{:.1f}%')
+
+
+def update_transrate(ax, sample):
+    return update_bars(ax, list(get_cache().get(sample, {}).get('transrate')), 0.02, '{:.3f}')
+
+
+def update_deamination(ax, sample):
+    data = get_cache().get(sample, {}).get('deamination')
+    # same order draw_deamination adds them in
+    for line, curve in zip(ax.lines, ['5p_AtoG', '5p_CtoT', '3p_AtoG', '3p_CtoT']):
+        line.set_ydata(data[curve])
+
+
+def update_inserts(ax, sample):
+    data = get_cache().get(sample, {}).get('inserts')
+    if not len(data['x']) or len(ax.lines) != 1:
+        return False
+    ax.lines[0].set_data(data['x'], data['y'])
+
+
+# transrate_contigs has a varying number of lines and autoscaled y, so it's always drawn in full
+TEMPLATE_UPDATE = {
+    'busco'      : update_busco,
+    'deamination': update_deamination,
+    'inserts'    : update_inserts,
+    'transrate'  : update_transrate,
+}
+
+
+def template_worker(args):
+    plot_type, sample, output_dir, max_y = args
+    path   = os.path.join(output_dir, plot_type, 'individual', f'{plot_type}_{sample}.png')
+    update = TEMPLATE_UPDATE.get(plot_type)
+
+    if update is not None and plot_type in TEMPLATES:
+        fig, ax = TEMPLATES[plot_type]
+        if update(ax, sample) is not False:
+            ax.title.set_text(f'{display_name(sample)}{TITLE_SUFFIX[plot_type]}')
+            save_figure(fig, [path], dpi=300)
+            return
+
+    fig, ax = individual_figure(plot_type, sample, max_y)
+    save_figure(fig, [path], dpi=300)
+    if update is not None and plot_type not in TEMPLATES:
+        TEMPLATES[plot_type] = (fig, ax)
+    else:
+        plt.close(fig)
+
+
+# samples in slide order, split into pages of SLIDE_NROWS x SLIDE_NCOLS
+def slide_pages():
+    per     = SLIDE_NROWS * SLIDE_NCOLS
+    samples = sorted(SAMPLES.keys(), key=lambda s: (TYPE_ORDER.index(sample_type(s)), s))
+    return [samples[i:i + per] for i in range(0, len(samples), per)] or [[]]
+
+
+# page 1 keeps the old name so nothing downstream changes while there are <= 20 samples
+def all_samples_path(plot_type, output_dir, page=1):
+    suffix = '' if page == 1 else f'_p{page}'
+    return os.path.join(output_dir, plot_type, f'{plot_type}_all_samples{suffix}.png')
+
+
+# makes a powerpoint slide of all the individual plots concatenated together, one page of them
+def plot_all_samples(plot_type, output_dir, page=1):
+    pages   = slide_pages()
+    samples = pages[page - 1]
+    print(f"{plot_type.capitalize():<12} - all samples" + (f" {page}/{len(pages)}" if len(pages) > 1 else ''))
     max_y   = get_cache()['inserts_y']['max_inserts_y'] if plot_type == 'inserts' else None
-    samples = sorted(SAMPLES.keys(),
-                     key=lambda s: (TYPE_ORDER.index(sample_type(s)), s))
 
     fig, axes = plt.subplots(SLIDE_NROWS, SLIDE_NCOLS, figsize=SLIDE_FIGSIZE)
     axes_flat = axes.flatten()
@@ -541,21 +1098,273 @@ def plot_all_samples(plot_type, output_dir):
             draw_inserts(ax, sample, max_y, FONTS_SLIDE, show_ylabel=show_ylabel)
         elif plot_type == 'transrate':
             draw_transrate(ax, sample, FONTS_SLIDE, show_ylabel=show_ylabel)
+        elif plot_type == 'transrate_contigs':
+            draw_transrate_contigs(ax, sample, FONTS_SLIDE, show_ylabel=show_ylabel, show_legend=False, linewidth=1)
 
     for ax in axes_flat[len(samples):]:
         ax.set_visible(False)
 
     plt.tight_layout(pad=0.8, h_pad=0.6, w_pad=0.4)
-    out_path = os.path.join(output_dir, plot_type, f'{plot_type}_all_samples.png')
-    plt.savefig(out_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    save_figure(fig, [all_samples_path(plot_type, output_dir, page)], dpi=300)
+    plt.close(fig)
 
-# individual plots for each sample of each analysis, transrate, busco etc
-def plot_individual(plot_type, output_dir, threads=16):
-    print(f"{plot_type.capitalize():<12} - individual")
+
+def all_samples_jobs(plot_type, output_dir):
+    jobs = []
+    for page, samples in enumerate(slide_pages(), 1):
+        jobs.append(FigureJob(f'all_samples:{plot_type}' + (f':p{page}' if page > 1 else ''),
+                              plot_all_samples, (plot_type, output_dir, page), weight=8,
+                              outputs=[all_samples_path(plot_type, output_dir, page)],
+                              inputs=rep_inputs(plot_type, samples)))
+    return jobs
+
+
+def individual_jobs(plot_type, output_dir, template=False, samples=None):
     os.makedirs(os.path.join(output_dir, plot_type, 'individual'), exist_ok=True)
-    max_y = get_cache()['inserts_y']['max_inserts_y'] if plot_type == 'inserts' else None
-    args  = [(plot_type, s, output_dir, max_y) for s in SAMPLES]
-    with mp.Pool(processes=threads) as pool:
-        pool.map(individual_worker, args)
-    plot_all_samples(plot_type, output_dir)
+    max_y  = get_cache()['inserts_y']['max_inserts_y'] if plot_type == 'inserts' else None
+    worker = template_worker if template else individual_worker
+    code   = (worker, INDIVIDUAL_DRAW[plot_type]) + ((TEMPLATE_UPDATE[plot_type],) if template and plot_type in TEMPLATE_UPDATE else ())
+    jobs   = [FigureJob(f'individual:{plot_type}:{s}', worker, ((plot_type, s, output_dir, max_y),),
+                        outputs=[os.path.join(output_dir, plot_type, 'individual', f'{plot_type}_{s}.png')],
+                        inputs=[(s, plot_type)],
+                        code=code)
+              for s in SAMPLES if selected(s, samples)]
+    return jobs + all_samples_jobs(plot_type, output_dir)
+
+
+# individual plots for each sample of each analysis, transrate, busco etc. on the caller's pool,
+# in this process without one
+def plot_individual(plot_type, output_dir, pool=None, template=False):
+    print(f"{plot_type.capitalize():<12} - individual")
+    return run_jobs(individual_jobs(plot_type, output_dir, template), pool)
+
+
+# inserts are drawn against the max over every sample, so they also depend on that
+def rep_inputs(plot_type, samples):
+    inputs = [(s, plot_type) for s in samples]
+    if plot_type == 'inserts':
+        inputs.append((None, 'inserts_y'))
+    return inputs
+
+
+# every figure main.py makes, as one list of jobs. weight is a rough relative cost so the
+# big figures start first and the individual plots fill in around them. samples only cuts down
+# the individual plots, the cross sample figures always cover the whole manifest
+def figure_jobs(plot_types, output_dir, representative=True, individual=True, template=False, rasterize=False,
+                ribbons=True, samples=None):
+    jobs = []
+    if representative:
+        jobs += [FigureJob(f'rep:{pt}', plot_rep, (pt, output_dir), weight=10,
+                           outputs=[os.path.join(output_dir, pt, f'{pt}_representative.png')],
+                           inputs=rep_inputs(pt, REPRESENTATIVE_SAMPLES))
+                 for pt in plot_types]
+        ordered = [pt for pt in CONCAT_PLOT_ORDER if pt in plot_types]
+        if len(ordered) > 1:
+            jobs.append(FigureJob('concat', concat_rep, (output_dir, plot_types, rasterize), weight=50,
+                                  outputs=[os.path.join(output_dir, f'representative_plots_concatenated.{ext}') for ext in ('svg', 'png')],
+                                  inputs=[i for pt in ordered for i in rep_inputs(pt, set(CONCAT_SAMPLES) | set(REPRESENTATIVE_SAMPLES))]))
+        if 'transrate' in plot_types:
+            jobs.append(FigureJob('transrate_scores', plot_transrate_scores, (output_dir,), weight=8,
+                                  outputs=[os.path.join(output_dir, 'transrate', 'transrate_scores.png')],
+                                  inputs=[(s, 'transrate') for s in SAMPLES]))
+        for pt in [pt for pt in ('deamination', 'inserts') if pt in plot_types]:
+            jobs.append(FigureJob(f'overlay:{pt}', plot_overlay, (pt, output_dir, ribbons), weight=4,
+                                  outputs=[os.path.join(output_dir, pt, f'{pt}_overlay.png')],
+                                  inputs=[(s, pt) for s in SAMPLES]))
+        if 'busco' in plot_types:
+            jobs.append(FigureJob('busco_categories', plot_busco_categories, (output_dir,), weight=8,
+                                  outputs=[os.path.join(output_dir, 'busco', 'busco_categories.png')],
+                                  inputs=[(s, 'busco') for s in SAMPLES]))
+    if individual:
+        for pt in plot_types:
+            jobs += individual_jobs(pt, output_dir, template, samples)
+    return jobs
+
+
+# read off the installed package metadata rather than matplotlib.__version__, which would import it
+def matplotlib_version():
+    global MATPLOTLIB_VERSION
+    if MATPLOTLIB_VERSION is None:
+        from importlib.metadata import version
+        MATPLOTLIB_VERSION = version('matplotlib')
+    return MATPLOTLIB_VERSION
+
+
+# the per sample tables change with every sample added to the manifest, so they're left out of the
+# code digest and render_key takes the display name and type of just the job's own samples
+SAMPLE_TABLES = ('SAMPLES', 'SAMPLE_NAMES', 'SAMPLE_TYPES', 'REGISTRY')
+
+
+# everything a figure's drawing code touches: the source of every function in this module it
+# (transitively) calls and the constants it reads. get_cache is left out, the data is keyed on its own
+def code_digest(fns):
+    h      = hashlib.sha1(matplotlib_version().encode())
+    seen   = set()
+    consts = {}
+    stack  = list(fns)
+    while stack:
+        fn = stack.pop()
+        if fn in seen or fn is get_cache:
+            continue
+        seen.add(fn)
+        h.update(inspect.getsource(fn).encode())
+        codes = [fn.__code__]
+        while codes:
+            code = codes.pop()
+            for name in code.co_names:
+                obj = globals().get(name)
+                if isinstance(obj, types.FunctionType) and obj.__module__ == __name__:
+                    stack.append(obj)
+                elif name.isupper() and name not in SAMPLE_TABLES and hasattr(constants, name):
+                    consts[name] = repr(getattr(constants, name))
+            codes += [c for c in code.co_consts if isinstance(c, types.CodeType)]
+    for name in sorted(consts):
+        h.update(f'{name}={consts[name]}'.encode())
+    return h.hexdigest()
+
+
+# hash of what is actually in the array cache, so a reparse that gives the same numbers keeps the figure
+def input_digest(index, sample, key):
+    if sample is None:
+        return json.dumps(index['aggregates'].get(key), sort_keys=True)
+    meta = index['samples'].get(sample, {}).get(key)
+    path = entry_path(sample, key)
+    if meta is None or not os.path.exists(path):
+        return 'missing'
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read() + json.dumps(meta, sort_keys=True).encode()).hexdigest()
+
+
+def render_key(job, index, memo):
+    code = job.code or (job.fn,)
+    if code not in memo:
+        memo[code] = code_digest(code)
+    h = hashlib.sha1(f'{job.name}\0{job.args!r}\0{memo[code]}'.encode())
+    for sample in sorted({s for s, _ in job.inputs if s is not None}):
+        h.update(f'{sample}\0{SAMPLE_NAMES.get(sample, sample)}\0{sample_type(sample)}'.encode())
+    for sample, key in sorted(job.inputs, key=lambda i: (i[0] or '', i[1])):
+        if (sample, key) not in memo:
+            memo[(sample, key)] = input_digest(index, sample, key)
+        h.update(f'{sample}\0{key}\0{memo[(sample, key)]}'.encode())
+    return h.hexdigest()
+
+
+def read_render_keys(output_dir):
+    path = os.path.join(output_dir, RENDER_KEYS)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def write_render_keys(output_dir, keys):
+    path = os.path.join(output_dir, RENDER_KEYS)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(keys, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+# splits the jobs into the ones whose outputs are missing or whose key changed, and the rest
+def stale_jobs(jobs, output_dir, force=False):
+    index = read_index() or empty_index()
+    old   = read_render_keys(output_dir)
+    memo  = {}
+    keys  = {job.name: render_key(job, index, memo) for job in jobs}
+    stale = [job for job in jobs
+             if force or old.get(job.name) != keys[job.name] or not all(os.path.exists(p) for p in job.outputs)]
+    return stale, keys
+
+
+# one worker pool for a whole run, main.py makes it from --threads and hands it to every render.
+# it's only forked the first time something is stale, so an up to date run never imports matplotlib
+class RenderPool:
+    def __init__(self, threads):
+        self.threads = threads
+        self.pool    = None
+
+    def get(self):
+        if self.pool is None and self.threads > 1:
+            import_render_modules()
+            self.pool = mp.Pool(processes=self.threads)
+        return self.pool
+
+    # close/join so the workers flush their png writes, terminate would drop them
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# only renders what changed and records the keys of everything that came out fine, on the
+# RenderPool if there is one and in this process otherwise. the workers' cpu is in their
+# figure: records and, once main.py closes the pool and reaps them, in the total
+def render(jobs, output_dir, pool=None, force=False):
+    stale, keys = stale_jobs(jobs, output_dir, force)
+    print(f"Rendering {len(stale)} of {len(jobs)} figures, {len(jobs) - len(stale)} unchanged")
+    failed = {}
+    if stale:
+        threads = pool.threads if pool is not None else 1
+        with profiling.stage('render', unit='figures', items=len(stale), threads=threads):
+            import_render_modules()
+            failed = run_jobs(stale, pool.get() if pool is not None else None)
+    done   = read_render_keys(output_dir)
+    for job in jobs:
+        if job.name in failed:
+            done.pop(job.name, None)
+        else:
+            done[job.name] = keys[job.name]
+    write_render_keys(output_dir, done)
+    rebuilt = [job.name for job in stale if job.name not in failed]
+    if rebuilt and len(rebuilt) <= 20:
+        print(f"Rebuilt: {', '.join(rebuilt)}")
+    return failed
+
+
+# one 'figure:<kind>' stage per job, tagged with its sample when it only draws one
+def profiling_args(job):
+    samples = {s for s, _ in job.inputs if s is not None}
+    sample  = samples.pop() if len(samples) == 1 else None
+    return (f"figure:{job.name.split(':')[0]}", run_job, (job.fn, job.args), sample, {'figure': job.name})
+
+
+# one job plus the pngs it queued on the encoder, so it only counts as done once its files are
+# written and a failed write fails the job (and keeps its render key out)
+def run_job(fn, args):
+    fn(*args)
+    failed = flush_encoder()
+    if failed:
+        raise OSError(f"writing {', '.join(failed)} failed")
+
+
+# runs the jobs on an existing pool, no figure reads another's output so they're all handed out at once,
+# heaviest first. with no pool everything runs in this process, cheapest first so single figures show up straight away
+def run_jobs(jobs, pool=None):
+    finished = queue.Queue()
+    failed   = {}
+    for job in sorted(jobs, key=lambda j: j.weight if pool is None else -j.weight):
+        fn, args = run_job, (job.fn, job.args)
+        if profiling.enabled():
+            fn, args = profiling.call, profiling_args(job)
+        if pool is None:
+            try:
+                fn(*args)
+                finished.put((job.name, None))
+            except Exception as e:
+                finished.put((job.name, e))
+        else:
+            pool.apply_async(fn, args,
+                             callback=lambda _, n=job.name: finished.put((n, None)),
+                             error_callback=lambda e, n=job.name: finished.put((n, e)))
+    for _ in jobs:
+        name, error = finished.get()
+        if error is not None:
+            failed[name] = error
+            print(f"Warning: {name} failed:\n{error}")
+    return failed
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import argparse
+import resource
+import threading
+from contextlib import contextmanager, nullcontext
+
+# --profile for every entry point. each stage (and each sample, figure or bam inside it) appends
+# one json line to the metrics file: wall, cpu and peak rss, plus a rate when it counts items.
+# the settings are passed on through the environment, so pool workers, spawned processes and
+# the stage subprocesses pipeline.py starts all write to the same file under the same run id.
+# no numpy/pandas here so it runs in the transrate env too.
+#
+#   python main.py --profile --cprofile prof/
+#   python profiling.py metrics.jsonl                 # last run against the one before it
+#   python profiling.py new.jsonl --against old.jsonl
+
+PROFILE_ENV   = 'HERBARIA_PROFILE'
+METRICS_FILE  = 'metrics.jsonl'
+HOT_FUNCTIONS = 25
+RSS_INTERVAL  = 0.1     # seconds between rss samples inside a stage
+
+PROFILER = None
+
+
+# user + system of this process and the children it has waited for
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+# high water marks over the whole life of the process, ru_maxrss is in kB on linux. only the
+# 'total' record uses it, a stage's own peak is sampled while it runs
+def peak_rss():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+class Profiler:
+    def __init__(self, entry, path=METRICS_FILE, run=None, cprofile=None):
+        self.entry    = entry
+        self.path     = os.path.abspath(path)
+        self.run      = run or f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.cprofile = os.path.abspath(cprofile) if cprofile else None
+        self.host     = socket.gethostname()
+        self.lock     = threading.Lock()
+        self.open     = {}      # stages running in this process -> [thread, most stages of other threads open beside it]
+
+    # one os.write per line on an O_APPEND fd, so lines from concurrent processes never interleave
+    def write(self, record):
+        record = dict(record, run=self.run, entry=self.entry, host=self.host, pid=os.getpid())
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record, sort_keys=True) + '\n').encode())
+        finally:
+            os.close(fd)
+
+    # the yielded dict goes into the record, set 'items' for a rate. cpu and peak_rss are for this
+    # process and its children while the stage ran, so stages nested in it and stages running next
+    # to it in other threads are in there too. 'overlap' is the most stages of other threads that
+    # were open at once during it, 0 means the cpu is its own and its nested stages'. a stage that
+    # watched a subprocess with ResourceMonitor can put its own 'cpu'/'peak_rss' in, those win
+    @contextmanager
+    def stage(self, name, sample=None, unit=None, **fields):
+        from resources import ResourceMonitor
+        token   = object()
+        with self.lock:
+            self.open[token] = [threading.get_ident(), 0]
+            for entry in self.open.values():
+                others   = sum(thread != entry[0] for thread, _ in self.open.values())
+                entry[1] = max(entry[1], others)
+        rec     = {}
+        status  = 'done'
+        start   = time.time()
+        wall    = time.perf_counter()
+        cpu     = cpu_seconds()
+        monitor = ResourceMonitor(os.getpid(), interval=RSS_INTERVAL)
+        try:
+            yield rec
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            usage = monitor.stop()
+            wall  = time.perf_counter() - wall
+            with self.lock:
+                overlap = self.open.pop(token)[1]
+            out   = {'stage': name, 'sample': sample, 'start': start, 'wall': wall, 'status': status,
+                     'cpu': cpu_seconds() - cpu, 'peak_rss': usage['peak_rss'], 'overlap': overlap, **fields, **rec}
+            if unit is not None:
+                out['unit'] = unit
+                out['rate'] = out.get('items', 0) / wall if wall > 0 else None
+            self.write(out)
+
+    # the slowest functions by their own time, next to the full dump for snakeviz/pstats
+    def hot(self, prof):
+        import pstats
+        os.makedirs(self.cprofile, exist_ok=True)
+        prof.dump_stats(os.path.join(self.cprofile, f'{self.entry}.{self.run}.{os.getpid()}.prof'))
+        stats = pstats.Stats(prof).stats
+        top   = sorted(stats.items(), key=lambda kv: -kv[1][2])[:HOT_FUNCTIONS]
+        self.write({'stage': 'hot', 'functions': [
+            {'function': f'{os.path.basename(path)}:{line}({fn})', 'calls': nc, 'self': tt, 'cumulative': ct}
+            for (path, line, fn), (_, nc, tt, ct, _) in top]})
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile',      action='store_true')       # per stage/sample metrics into --metrics-file
+    parser.add_argument('--metrics-file', default=METRICS_FILE)
+    parser.add_argument('--cprofile',     default=None)              # also dump cProfile stats (and the hottest functions) here
+
+
+# called once by every entry point. also turns on in a process started by a profiled one
+def setup(entry, args=None):
+    global PROFILER
+    inherited = json.loads(os.environ[PROFILE_ENV]) if os.environ.get(PROFILE_ENV) else None
+    if args is not None and (args.profile or args.cprofile):
+        PROFILER = Profiler(entry, args.metrics_file, inherited and inherited['run'], args.cprofile)
+    elif inherited:
+        PROFILER = Profiler(entry, inherited['path'], inherited['run'], inherited['cprofile'])
+    else:
+        return None
+    os.environ[PROFILE_ENV] = json.dumps({'entry': entry, 'path': PROFILER.path, 'run': PROFILER.run,
+                                          'cprofile': PROFILER.cprofile})
+
+    start, cpu = time.perf_counter(), cpu_seconds()
+    prof       = None
+    if PROFILER.cprofile:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+
+    def finish():
+        if prof is not None:
+            prof.disable()
+            PROFILER.hot(prof)
+        PROFILER.write({'stage': 'total', 'argv': sys.argv, 'wall': time.perf_counter() - start,
+                        'cpu': cpu_seconds() - cpu, 'peak_rss': peak_rss()})
+    atexit.register(finish)
+    return PROFILER
+
+
+# the profiler of this process. a spawned worker has no module state, it picks it up from the environment
+def get():
+    global PROFILER
+    if PROFILER is None and os.environ.get(PROFILE_ENV):
+        config   = json.loads(os.environ[PROFILE_ENV])
+        PROFILER = Profiler(config['entry'], config['path'], config['run'])
+    return PROFILER
+
+
+def stage(name, sample=None, unit=None, **fields):
+    profiler = get()
+    if profiler is None:
+        return nullcontext({})
+    return profiler.stage(name, sample, unit, **fields)
+
+
+# fn(*args) as its own stage, a plain function so it can go through a pool
+def call(name, fn, args, sample=None, fields=None):
+    with stage(name, sample, **(fields or {})):
+        return fn(*args)
+
+
+def enabled():
+    return get() is not None
+
+
+def load_runs(path):
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                runs.setdefault(rec['run'], []).append(rec)
+    return runs
+
+
+# (entry, stage) -> records, wall/cpu summed, peak the max, rate over the summed wall
+def summarise(records):
+    out = {}
+    for rec in records:
+        if rec['stage'] == 'hot':
+            continue
+        s = out.setdefault((rec['entry'], rec['stage']), {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0,
+                                                          'items': 0, 'unit': None, 'failed': 0, 'overlap': 0})
+        s['n']        += 1
+        s['wall']     += rec.get('wall') or 0.0
+        s['cpu']      += rec.get('cpu') or 0.0
+        s['peak_rss']  = max(s['peak_rss'], rec.get('peak_rss') or 0)
+        s['items']    += rec.get('items') or 0
+        s['unit']      = rec.get('unit') or s['unit']
+        s['failed']   += rec.get('status') == 'failed'
+        s['overlap']  += bool(rec.get('overlap'))
+    return out
+
+
+def report_hot(records, top=10):
+    for rec in records:
+        if rec['stage'] == 'hot':
+            print(f"\n{rec['entry']} (pid {rec['pid']}) hottest by own time")
+            for f in rec['functions'][:top]:
+                print(f"    {f['self']:>8.2f} s {f['cumulative']:>8.2f} s cum {f['calls']:>9}  {f['function']}")
+
+
+def report(new, old=None):
+    new, old = summarise(new), summarise(old or [])
+    mb = 1024 ** 2
+    print(f"{'entry':<12}{'stage':<22}{'n':>6}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'rate':>20}{'vs old wall':>13}")
+    for key in sorted(set(new) | set(old)):
+        s = new.get(key)
+        o = old.get(key)
+        if s is None:
+            print(f"{key[0]:<12}{key[1]:<22}{'gone':>6}")
+            continue
+        rate = f"{s['items'] / s['wall']:.1f} {s['unit']}/s" if s['unit'] and s['wall'] else ''
+        diff = f"{(s['wall'] - o['wall']) / o['wall'] * 100:+.0f}%" if o and o['wall'] else ('new' if old else '')
+        note = f"  {s['failed']} failed" if s['failed'] else ''
+        # their cpu includes whatever else this process was running at the time
+        note += f"  {s['overlap']} overlapped" if s['overlap'] else ''
+        print(f"{key[0]:<12}{key[1]:<22}{s['n']:>6}{s['wall']:>10.2f}{s['cpu']:>10.2f}{s['peak_rss'] / mb:>10.0f}"
+              f"{rate:>20}{diff:>13}{note}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary of a --profile metrics file')
+    parser.add_argument('metrics', nargs='?', default=METRICS_FILE)
+    parser.add_argument('--against', default=None)             # other metrics file, its last run is the baseline
+    parser.add_argument('--run',     default=None)             # run id to show instead of the last one
+    parser.add_argument('--hot',     type=int, default=10)     # hottest functions listed per --cprofile dump
+    args = parser.parse_args()
+
+    runs = load_runs(args.metrics)
+    ids  = list(runs)
+    if not ids:
+        print(f'No runs in {args.metrics}')
+        sys.exit()
+    run  = args.run or ids[-1]
+    if args.against:
+        base = list(load_runs(args.against).values())[-1]
+    else:
+        base = runs[ids[ids.index(run) - 1]] if ids.index(run) > 0 else None
+    print(f'run {run}' + (f" against {base[0]['run']}" if base else ''))
+    report(runs[run], base)
+    report_hot(runs[run], args.hot)
@@ -0,0 +1,119 @@
+import os
+import csv
+
+# the sample manifest, samples.tsv next to this file (or HERBARIA_MANIFEST): one row per
+# sample with its display name, preservation type and file stem, and optionally where each of
+# its result files is (busco, deamination, inserts, transrate, transrate_contigs columns, relative
+# to the manifest, blank for the usual place under 02_data). read once per process into
+# a registry indexed by sample and by type, constants.py builds SAMPLES/SAMPLE_NAMES from it.
+# every entry point takes the same --samples/--types to work on a subset:
+#
+#   python main.py --samples WA13,DAL192
+#   python pipeline.py --types herbaria
+#
+# no numpy/pandas here so it runs in the transrate env too.
+
+MANIFEST_ENV  = 'HERBARIA_MANIFEST'
+MANIFEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples.tsv')
+PATH_COLUMNS  = ('busco', 'deamination', 'inserts', 'transrate', 'transrate_contigs')
+COLUMNS       = ('sample', 'display_name', 'type', 'stem') + PATH_COLUMNS
+
+REGISTRY = None
+
+
+class Registry:
+    def __init__(self, rows):
+        self.rows    = {r['sample']: r for r in rows}   # manifest order
+        self.by_type = {}
+        for r in rows:
+            self.by_type.setdefault(r['type'], []).append(r['sample'])
+
+    def __contains__(self, sample):
+        return sample in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def type(self, sample):
+        return self.rows[sample]['type'] if sample in self.rows else 'unknown'
+
+    # file name of the busco/inserts outputs, WA samples were sequenced as _paired
+    def stem(self, sample):
+        return self.rows[sample]['stem'] if sample in self.rows else sample
+
+    # the manifest's path for one of the sample's result files, None for the default location
+    def path(self, sample, key):
+        return (self.rows[sample][key] or None) if sample in self.rows else None
+
+    def stems(self):
+        return {s: r['stem'] for s, r in self.rows.items()}
+
+    def names(self):
+        return {s: r['display_name'] for s, r in self.rows.items()}
+
+    def types(self):
+        return {s: r['type'] for s, r in self.rows.items()}
+
+    # --samples picks ids, --types narrows to preservation types, None when neither is given.
+    # ids missing from the manifest can still be asked for by name, they just have no type
+    def select(self, samples=(), types=()):
+        if not samples and not types:
+            return None
+        unknown = [t for t in types if t not in self.by_type]
+        if unknown:
+            print(f"Warning: no {', '.join(unknown)} samples in the manifest")
+        chosen = list(samples) if samples else list(self.rows)
+        return {s for s in chosen if not types or self.type(s) in types}
+
+
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    rows = []
+    with open(path, newline='') as f:
+        lines  = (line for line in f if line.strip() and not line.startswith('#'))
+        for n, row in enumerate(csv.DictReader(lines, delimiter='\t'), 1):
+            missing = [c for c in COLUMNS[:3] if not (row.get(c) or '').strip()]
+            if missing:
+                raise ValueError(f"{path}: row {n} has no {', '.join(missing)}")
+            row         = {c: (row.get(c) or '').strip() for c in COLUMNS}
+            row['stem'] = row['stem'] or row['sample']
+            for c in PATH_COLUMNS:
+                if row[c]:
+                    row[c] = os.path.normpath(os.path.join(base, os.path.expanduser(row[c])))
+            rows.append(row)
+    return rows
+
+
+def manifest_path():
+    return os.environ.get(MANIFEST_ENV) or MANIFEST_FILE
+
+
+def load(path=None):
+    global REGISTRY
+    if path is None and REGISTRY is not None:
+        return REGISTRY
+    registry = Registry(read_manifest(path or manifest_path()))
+    if path is None:
+        REGISTRY = registry
+    return registry
+
+
+def add_arguments(parser):
+    parser.add_argument('--samples', default='', help='Only these sample ids, comma separated')
+    parser.add_argument('--types',   default='', help='Only these preservation types from the manifest (fresh, silica, herbaria), comma separated')
+
+
+def split(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+# the set of sample ids args.samples/args.types leave, None for all of them
+def selection(args):
+    return load().select(split(args.samples), split(args.types))
+
+
+def selected(sample, chosen):
+    return chosen is None or sample in chosen
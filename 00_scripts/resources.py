@@ -0,0 +1,167 @@
+import os
+import math
+import time
+import argparse
+import threading
+import psutil
+from ledger import Ledger, LEDGER_FILE
+
+# samples a child process (and everything it spawns) while it runs.
+# cpu and io counters are kept per pid at their last seen value so children
+# that exit between samples still count towards the totals.
+class ResourceMonitor:
+    def __init__(self, pid, interval=1.0):
+        self.pid      = pid
+        self.interval = interval
+        self.start    = time.time()
+        self.cpu      = {}
+        self.io       = {}
+        self.peak_rss = 0
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            parent = psutil.Process(self.pid)
+            procs  = [parent] + parent.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    cpu = proc.cpu_times()
+                    rss += proc.memory_info().rss
+                    self.cpu[proc.pid] = cpu.user + cpu.system
+                    if hasattr(proc, 'io_counters'):
+                        io = proc.io_counters()
+                        self.io[proc.pid] = (io.read_bytes, io.write_bytes)
+            except psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+        self.thread.join()
+        return {
+            'wall'       : time.time() - self.start,
+            'cpu'        : sum(self.cpu.values()),
+            'peak_rss'   : self.peak_rss,
+            'read_bytes' : sum(r for r, _ in self.io.values()),
+            'write_bytes': sum(w for _, w in self.io.values()),
+        }
+
+
+# cores shared by jobs that each ask for a number of threads
+class CoreBudget:
+    def __init__(self, cores):
+        self.total = cores
+        self.free  = cores
+        self.cond  = threading.Condition()
+
+    # takes the first job (in order) that fits in the free cores, None if none do
+    def fit(self, jobs):
+        with self.cond:
+            for job in jobs:
+                if job['threads'] <= self.free:
+                    jobs.remove(job)
+                    self.free -= job['threads']
+                    return job
+            return None
+
+    # same but waits until one does
+    def take(self, jobs):
+        with self.cond:
+            while True:
+                job = self.fit(jobs)
+                if job is not None:
+                    return job
+                self.cond.wait()
+
+    def release(self, threads):
+        with self.cond:
+            self.free += threads
+            self.cond.notify_all()
+
+
+# least squares wall ~ a + b * input_bytes, no numpy so it runs in the transrate env
+def regression(points):
+    n = len(points)
+    if n < 2:
+        return None
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    syy = sum((y - my) ** 2 for _, y in points)
+    sxy = sum((x - mx) * (y - my) for x, y in points)
+    if sxx == 0:
+        return None
+    slope = sxy / sxx
+    r2    = (sxy * sxy) / (sxx * syy) if syy else 1.0
+    return {'intercept': my - slope * mx, 'slope': slope, 'r2': r2, 'n': n}
+
+
+# median cpu seconds per wall second of past finished jobs, i.e. how many cores they really kept busy
+def utilisation(ledger, stage, organelle=None):
+    used = sorted(a['resources']['cpu'] / a['resources']['wall']
+                  for a in ledger.attempts(stage)
+                  if a['status'] == 'done' and a['resources'] and a['resources'].get('wall')
+                  and (organelle is None or a['organelle'] == organelle))
+    if not used:
+        return None
+    return used[len(used) // 2]
+
+
+def suggest_threads(ledger, stage, organelle, max_threads):
+    used = utilisation(ledger, stage, organelle)
+    if used is None:
+        return max_threads
+    return max(1, min(max_threads, math.ceil(used * 1.25)))
+
+
+def report(ledger, top=10):
+    runs = [a for a in ledger.attempts() if a['resources']]
+    if not runs:
+        print('No resource records in the ledger')
+        return
+    gb = 1024 ** 3
+
+    print(f'\nSlowest {top} jobs')
+    for a in sorted(runs, key=lambda a: -a['resources']['wall'])[:top]:
+        r = a['resources']
+        print(f"{a['stage']:<12}{a['sample']:<10}{a['organelle']:<10}{r['wall']/60:>8.1f} min  {r['cpu']/max(r['wall'], 1e-9):>6.1f} cores")
+
+    print(f'\nHungriest {top} jobs')
+    for a in sorted(runs, key=lambda a: -a['resources']['peak_rss'])[:top]:
+        r = a['resources']
+        print(f"{a['stage']:<12}{a['sample']:<10}{a['organelle']:<10}{r['peak_rss']/gb:>8.2f} GB  {(r['read_bytes'] + r['write_bytes'])/gb:>8.2f} GB io")
+
+    print('\nWall time vs input size')
+    groups = {}
+    for a in runs:
+        if a['status'] == 'done' and a.get('input_bytes'):
+            groups.setdefault((a['stage'], a['organelle']), []).append((a['input_bytes'] / gb, a['resources']['wall']))
+    for (stage, organelle), points in sorted(groups.items()):
+        fit = regression(points)
+        if fit is None:
+            print(f'{stage:<12}{organelle:<10}not enough runs ({len(points)})')
+            continue
+        print(f"{stage:<12}{organelle:<10}{fit['intercept']/60:>7.1f} min + {fit['slope']/60:>7.1f} min/GB  r2={fit['r2']:.2f}  n={fit['n']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resource report from the run ledger')
+    parser.add_argument('--ledger', default=LEDGER_FILE)
+    parser.add_argument('--top',    type=int, default=10)
+    args = parser.parse_args()
+    if not os.path.exists(args.ledger):
+        print(f'No ledger at {args.ledger}')
+    else:
+        report(Ledger(args.ledger), args.top)
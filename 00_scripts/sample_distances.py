@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+from matplotlib.patches import Patch
+from constants import *
+import registry
+import profiling
+from plots import get_cache, sample_type, save_figure, flush_encoder, INSERT_MAX
+
+# pairwise distances between every two samples, on a samples x bins matrix:
+#   ks, wasserstein (bp), js   insert length histograms, 1..INSERT_MAX
+#   damage                     euclidean between the 4 deamination curves laid end to end
+# pairs are done a block of rows at a time so the samples x samples x bins
+# intermediate never goes over BLOCK_BYTES, whatever the sample count.
+#
+#   python sample_distances.py --metrics ks,js,damage
+#   python sample_distances.py --types silica,herbaria
+
+BLOCK_BYTES = 16 * 1024 ** 2
+METRICS     = ('ks', 'wasserstein', 'js', 'damage')
+DEAM_ORDER  = ('5p_CtoT', '5p_AtoG', '3p_CtoT', '3p_AtoG')
+TITLES      = {
+    'ks'         : 'Insert Length KS Distance',
+    'wasserstein': 'Insert Length Wasserstein Distance (bp)',
+    'js'         : 'Insert Length Jensen-Shannon Distance',
+    'damage'     : 'Deamination Curve Distance',
+}
+
+
+# rows are normalised insert length histograms, samples without any inserts are left out
+def insert_matrix(cache, samples):
+    counts = np.zeros((len(samples), INSERT_MAX), dtype=np.float64)
+    for i, s in enumerate(samples):
+        data = cache.get(s, {}).get('inserts')
+        if data is not None and len(data['x']):
+            counts[i, np.asarray(data['x']) - 1] = data['y']
+    totals = counts.sum(axis=1)
+    keep   = totals > 0
+    return [s for s, k in zip(samples, keep) if k], counts[keep] / totals[keep, None]
+
+
+def damage_matrix(cache, samples):
+    keep = [s for s in samples if cache.get(s, {}).get('deamination') is not None]
+    rows = [np.concatenate([np.asarray(cache[s]['deamination'][c], dtype=np.float64) for c in DEAM_ORDER])
+            for s in keep]
+    return keep, np.array(rows).reshape(len(keep), -1)
+
+
+# rows per block so one block's rows x samples x bins intermediate stays around BLOCK_BYTES,
+# small enough to stay in cache which matters more here than the numpy call overhead
+def blockwise(A, fn, outputs=1):
+    n    = len(A)
+    outs = [np.empty((n, n)) for _ in range(outputs)]
+    step = max(1, BLOCK_BYTES // max(1, n * A.shape[1] * 8))
+    for i in range(0, n, step):
+        res = fn(A[i:i + step, None, :], A[None, :, :])
+        for out, r in zip(outs, res if outputs > 1 else (res,)):
+            out[i:i + step] = r
+    return outs if outputs > 1 else outs[0]
+
+
+# ks is the largest gap between the cdfs, wasserstein the area between them (1 bp bins, so in bp).
+# both come off the same difference block
+def cdf_block(a, b):
+    d = a - b
+    np.abs(d, out=d)
+    return d.max(axis=2), d.sum(axis=2)
+
+
+def ks_wasserstein(P):
+    return blockwise(np.cumsum(P, axis=1), cdf_block, outputs=2)
+
+
+# sum m log2 m. the 1e-300 only keeps 0 * log(0) at 0, it doesn't move any real value
+def plogp(x):
+    t  = np.log2(x + 1e-300)
+    t *= x
+    return t.sum(axis=-1)
+
+
+def mixture_block(a, b):
+    m  = a + b
+    m *= 0.5
+    return plogp(m)
+
+
+# js divergence = H(m) - (H(p) + H(q)) / 2, only H(m) needs the pairs. reported as the distance (sqrt)
+def js(P):
+    h   = plogp(P)
+    div = (h[:, None] + h[None, :]) / 2 - blockwise(P, mixture_block)
+    np.fill_diagonal(div, 0.0)
+    return np.sqrt(np.clip(div, 0.0, 1.0))
+
+
+# gram matrix form, no pairwise intermediate at all
+def euclidean(X):
+    sq = (X * X).sum(axis=1)
+    D  = sq[:, None] + sq[None, :] - 2 * X @ X.T
+    np.fill_diagonal(D, 0.0)
+    return np.sqrt(np.clip(D, 0.0, None))
+
+
+def distances(metrics, cache=None, samples=None):
+    cache   = get_cache() if cache is None else cache
+    samples = list(SAMPLES if samples is None else samples)
+    out     = {}
+    if set(metrics) & {'ks', 'wasserstein', 'js'}:
+        kept, P = insert_matrix(cache, samples)
+        if set(metrics) & {'ks', 'wasserstein'}:
+            K, W = ks_wasserstein(P)
+            out.update({m: (kept, D) for m, D in (('ks', K), ('wasserstein', W)) if m in metrics})
+        if 'js' in metrics:
+            out['js'] = (kept, js(P))
+    if 'damage' in metrics:
+        kept, X = damage_matrix(cache, samples)
+        out['damage'] = (kept, euclidean(X))
+    return out
+
+
+# spectral ordering (fiedler vector of the similarity graph) so similar samples sit together,
+# a numpy only stand in for hierarchical clustering that's fine with thousands of samples
+def seriate(D):
+    n = len(D)
+    if n < 3:
+        return np.arange(n)
+    scale = np.median(D[D > 0]) if (D > 0).any() else 1.0
+    S     = np.exp(-D / scale)
+    L     = np.diag(S.sum(axis=1)) - S
+    _, vecs = np.linalg.eigh(L)
+    return np.argsort(vecs[:, 1], kind='stable')
+
+
+# grouped by TYPE_ORDER, clustered inside each group
+def heatmap_order(samples, D):
+    type_rank = lambda s: TYPE_ORDER.index(sample_type(s)) if sample_type(s) in TYPE_ORDER else len(TYPE_ORDER)
+    order, bounds = [], []
+    for rank in sorted({type_rank(s) for s in samples}):
+        idx = np.array([i for i, s in enumerate(samples) if type_rank(s) == rank])
+        order += idx[seriate(D[np.ix_(idx, idx)])].tolist()
+        bounds.append(len(order))
+    return np.array(order), bounds[:-1]
+
+
+def plot_heatmap(metric, samples, D, plot_dir):
+    order, bounds = heatmap_order(samples, D)
+    names  = [samples[i] for i in order]
+    colors = np.array([[to_rgb(COLORS.get(sample_type(s), '#999999'))] for s in names])
+
+    fig, ax = plt.subplots(1, 1, figsize=(11, 10))
+    im = ax.imshow(D[np.ix_(order, order)], cmap='viridis', interpolation='nearest', aspect='equal')
+    for b in bounds:
+        ax.axhline(b - 0.5, color='white', linewidth=1.5)
+        ax.axvline(b - 0.5, color='white', linewidth=1.5)
+
+    left = ax.inset_axes([-0.035, 0, 0.02, 1])
+    left.imshow(colors, aspect='auto', interpolation='nearest')
+    top  = ax.inset_axes([0, 1.01, 1, 0.02])
+    top.imshow(colors.transpose(1, 0, 2), aspect='auto', interpolation='nearest')
+    for strip in (left, top):
+        strip.set_xticks([])
+        strip.set_yticks([])
+
+    # names only while they are still readable
+    if len(names) <= 60:
+        labels = [SAMPLE_NAMES.get(s, s).split('-')[0] for s in names]
+        ax.set_xticks(range(len(names)))
+        ax.set_xticklabels(labels, rotation=90, fontsize=8)
+        ax.set_yticks(range(len(names)))
+        ax.set_yticklabels(labels, fontsize=8)
+        ax.tick_params(axis='y', pad=18)
+    else:
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+    fig.colorbar(im, ax=ax, fraction=0.04, pad=0.02)
+    ax.set_title(TITLES[metric], fontsize=16, fontweight='bold', pad=28)
+    legend_patches = [Patch(facecolor=COLORS[t], label=TYPE_DISPLAY[t]) for t in TYPE_ORDER]
+    fig.legend(handles=legend_patches, loc='upper center', ncol=3, framealpha=0.8, bbox_to_anchor=(0.5, 0.0))
+
+    save_figure(fig, [os.path.join(plot_dir, f'{metric}_heatmap.png')], dpi=300)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pairwise sample distances for inserts and deamination')
+    parser.add_argument('--metrics',  default=','.join(METRICS))
+    parser.add_argument('--out-dir',  default=os.path.join(DATA_DIR, 'sample_distances'))
+    parser.add_argument('--plot-dir', default='./01_plots/sample_distances')
+    parser.add_argument('--no-plots', action='store_true')
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('distances', args)
+
+    metrics = [m for m in args.metrics.split(',') if m in METRICS]
+    chosen  = registry.selection(args)
+    samples = [s for s in SAMPLES if registry.selected(s, chosen)]
+    os.makedirs(args.out_dir, exist_ok=True)
+    os.makedirs(args.plot_dir, exist_ok=True)
+
+    start   = time.perf_counter()
+    with profiling.stage('distances', unit='samples', metrics=metrics) as rec:
+        results      = distances(metrics, samples=samples)
+        rec['items'] = len(samples)
+    print(f"{len(results)} distance matrices in {time.perf_counter() - start:.2f} s")
+    for metric, (samples, D) in results.items():
+        pd.DataFrame(D, index=samples, columns=samples).to_csv(os.path.join(args.out_dir, f'{metric}.csv'))
+        if not args.no_plots:
+            print(f"{metric:<12} - heatmap")
+            with profiling.stage(f'heatmap:{metric}'):
+                plot_heatmap(metric, samples, D, args.plot_dir)
+    flush_encoder()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import sqlite3
+import argparse
+import registry
+import profiling
+from constants import *
+
+# one sqlite file with every stage's results in long format:
+#   metrics(sample, stage, metric, part, position, value)
+# part is the read end for deamination ('5p'/'3p'), the kind of row for the contig
+# summaries ('hist', 'quantile', 'edge'), and '' otherwise. sample ids are always taken
+# from the path of the file that was ingested, never from list order.
+#
+#   python store.py ingest
+#   python store.py query "SELECT m.sample, m.value FROM metrics m JOIN samples s USING (sample)
+#                          WHERE s.type='silica' AND m.metric='C>T' AND m.part='5p' AND m.position=1"
+
+STORE_FILE = os.path.join(DATA_DIR, 'results.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    sample       TEXT PRIMARY KEY,
+    display_name TEXT,
+    type         TEXT
+);
+CREATE TABLE IF NOT EXISTS sources (
+    path   TEXT PRIMARY KEY,
+    sample TEXT NOT NULL,
+    stage  TEXT NOT NULL,
+    size   INTEGER,
+    mtime  INTEGER
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    sample   TEXT NOT NULL,
+    stage    TEXT NOT NULL,
+    metric   TEXT NOT NULL,
+    part     TEXT NOT NULL DEFAULT '',
+    position REAL,
+    value    REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_sample ON metrics (sample, metric, position);
+CREATE INDEX IF NOT EXISTS metrics_metric ON metrics (metric, part, position);
+CREATE INDEX IF NOT EXISTS metrics_stage  ON metrics (stage, sample);
+'''
+
+
+def strip_sample(name, *suffixes):
+    for suffix in suffixes:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+# busco and inserts files go by the manifest's file stem, files of samples outside it by their name less _paired
+def stem_sample(stems, stem):
+    return stems.get(stem) or strip_sample(stem, '_paired')
+
+
+# (stage, sample, path) for everything under DATA_DIR, and the files the manifest's path columns
+# point at instead for the samples that have them
+def find_sources(data_dir=DATA_DIR):
+    sources = []
+    stems   = {stem: s for s, stem in SAMPLES.items()}
+    for path in glob.glob(os.path.join(data_dir, 'busco', '*', 'short_summary*.txt')):
+        sources.append(('busco', stem_sample(stems, strip_sample(os.path.basename(os.path.dirname(path)), '_busco')), path))
+    for path in glob.glob(os.path.join(data_dir, 'deamination', '*', 'misincorporation.txt')):
+        sources.append(('deamination', os.path.basename(os.path.dirname(path)), path))
+    for path in glob.glob(os.path.join(data_dir, 'inserts', '*.csv')):
+        sources.append(('inserts', stem_sample(stems, os.path.splitext(os.path.basename(path))[0]), path))
+    for path in glob.glob(os.path.join(data_dir, 'transrate', '*.csv')):
+        sources.append(('transrate', os.path.splitext(os.path.basename(path))[0], path))
+    for path in glob.glob(os.path.join(data_dir, 'transrate_contigs', '*.json')):
+        sources.append(('transrate_contigs', os.path.splitext(os.path.basename(path))[0], path))
+    moved   = {(stage, s): REGISTRY.path(s, stage) for s in REGISTRY for stage in registry.PATH_COLUMNS
+               if REGISTRY.path(s, stage)}
+    sources = [src for src in sources if (src[0], src[1]) not in moved]
+    sources += [(stage, s, path) for (stage, s), path in moved.items() if os.path.exists(path)]
+    return sorted(sources)
+
+
+def rows_busco(path):
+    from plots import parse_busco
+    data = parse_busco(path) or {}
+    return [(k, '', None, float(v)) for k, v in data.items()]
+
+
+# every position, summed over references and strands the same way plots.parse_deamination does
+def rows_deamination(path):
+    import pandas as pd
+    from plots import deamination_totals
+    totals = deamination_totals(pd.read_csv(path, sep='\t'))
+    subs   = [c for c in totals.columns if '>' in c or c == 'S']
+    rows   = []
+    for (end, pos), row in totals.iterrows():
+        total = row['Total']
+        rows.append(('Total', end, int(pos), float(total)))
+        for sub in subs:
+            count = row[sub]
+            rows.append((sub, end, int(pos), float(count / total) if total > 0 else 0.0))
+            rows.append((f'{sub}_count', end, int(pos), float(count)))
+    return rows
+
+
+def rows_inserts(path):
+    from plots import parse_inserts
+    data = parse_inserts(path)
+    return [('insert_length', '', int(x), float(y)) for x, y in zip(data['x'], data['y'])]
+
+
+def rows_transrate(path):
+    import pandas as pd
+    df   = pd.read_csv(path, nrows=1)
+    rows = []
+    for col in df.columns:
+        value = pd.to_numeric(df[col], errors='coerce').iloc[0]
+        if pd.notna(value):
+            rows.append((col, '', None, float(value)))
+    return rows
+
+
+def rows_transrate_contigs(path):
+    from plots import parse_transrate_contigs
+    data = parse_transrate_contigs(path)
+    rows = [('contigs', '', None, float(data['contigs']))]
+    rows += [('edge', 'edge', i, float(e)) for i, e in enumerate(data['edges'])]
+    for col, counts in data['counts'].items():
+        rows += [(col, 'hist', i, float(c)) for i, c in enumerate(counts)]
+    for col, qs in data['quantiles'].items():
+        rows += [(col, 'quantile', float(q), v) for q, v in qs.items()]
+    return rows
+
+
+READERS = {
+    'busco'            : rows_busco,
+    'deamination'      : rows_deamination,
+    'inserts'          : rows_inserts,
+    'transrate'        : rows_transrate,
+    'transrate_contigs': rows_transrate_contigs,
+}
+
+
+def connect(path=STORE_FILE):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sample_type_of(sample):
+    from plots import sample_type
+    return sample_type(sample)
+
+
+# only files whose size/mtime changed since the last ingest are re-read, and only the selected samples' files
+def ingest(path=STORE_FILE, data_dir=DATA_DIR, force=False, samples=None):
+    conn    = connect(path)
+    known   = {p: (size, mtime) for p, size, mtime in conn.execute('SELECT path, size, mtime FROM sources')}
+    sources = find_sources(data_dir)
+    changed = 0
+    for stage, sample, src in sources:
+        if not registry.selected(sample, samples):
+            continue
+        st = os.stat(src)
+        if not force and known.get(src) == (st.st_size, st.st_mtime_ns):
+            continue
+        try:
+            with profiling.stage(f'ingest:{stage}', sample, unit='rows') as rec:
+                rows         = READERS[stage](src)
+                rec['items'] = len(rows)
+        except Exception as e:
+            print(f"Warning: {stage} ingest failed for {sample}:\n{e}")
+            continue
+        with conn:
+            conn.execute('DELETE FROM metrics WHERE sample=? AND stage=?', (sample, stage))
+            conn.executemany('INSERT INTO metrics (sample, stage, metric, part, position, value) VALUES (?, ?, ?, ?, ?, ?)',
+                             [(sample, stage, m, part, pos, v) for m, part, pos, v in rows])
+            conn.execute('INSERT OR REPLACE INTO sources (path, sample, stage, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                         (src, sample, stage, st.st_size, st.st_mtime_ns))
+            conn.execute('INSERT OR REPLACE INTO samples (sample, display_name, type) VALUES (?, ?, ?)',
+                         (sample, SAMPLE_NAMES.get(sample, sample), sample_type_of(sample)))
+        changed += 1
+    # files that disappeared take their rows with them
+    present = {src for _, _, src in sources}
+    with conn:
+        for src, sample, stage in conn.execute('SELECT path, sample, stage FROM sources').fetchall():
+            if src not in present:
+                conn.execute('DELETE FROM metrics WHERE sample=? AND stage=?', (sample, stage))
+                conn.execute('DELETE FROM sources WHERE path=?', (src,))
+    print(f"Ingested {changed} of {len(sources)} files into {path}")
+    conn.close()
+    return changed
+
+
+# rebuilds the same per sample entries plots.build_cache makes from the raw files
+def load_entries(path=STORE_FILE):
+    conn    = connect(path)
+    entries = {}
+    rows    = conn.execute('SELECT sample, stage, metric, part, position, value FROM metrics ORDER BY sample, stage, position')
+    grouped = {}
+    for sample, stage, metric, part, pos, value in rows:
+        grouped.setdefault((sample, stage), []).append((metric, part, pos, value))
+    conn.close()
+
+    for (sample, stage), rows in grouped.items():
+        entry = entries.setdefault(sample, {})
+        if stage == 'busco':
+            data = {m: v for m, _, _, v in rows}
+            entry['busco'] = {k: (int(v) if k.endswith('_count') else v) for k, v in data.items()}
+        elif stage == 'deamination':
+            freq = {(m, part, int(pos)): v for m, part, pos, v in rows}
+            def curve(end, sub):
+                return [freq.get((sub, end, p), 0) for p in range(1, 26)]
+            c3t = curve('3p', 'C>T'); c3t.reverse()
+            a3g = curve('3p', 'A>G'); a3g.reverse()
+            entry['deamination'] = {'5p_CtoT': curve('5p', 'C>T'), '5p_AtoG': curve('5p', 'A>G'),
+                                    '3p_CtoT': c3t, '3p_AtoG': a3g}
+        elif stage == 'inserts':
+            entry['inserts'] = {'x': [int(p) for _, _, p, _ in rows], 'y': [int(v) for _, _, _, v in rows]}
+        elif stage == 'transrate':
+            data = {m: v for m, _, _, v in rows}
+            entry['transrate'] = [data.get(c, 0.0) for c in TRANSRATE_COLS]
+        elif stage == 'transrate_contigs':
+            counts, quantiles, edges, contigs = {}, {}, [], 0
+            for m, part, pos, v in rows:
+                if part == 'hist':
+                    counts.setdefault(m, []).append(int(v))
+                elif part == 'quantile':
+                    quantiles.setdefault(m, {})[str(pos)] = v
+                elif part == 'edge':
+                    edges.append(v)
+                elif m == 'contigs':
+                    contigs = int(v)
+            entry['transrate_contigs'] = {'edges': edges, 'contigs': contigs, 'counts': counts, 'quantiles': quantiles}
+    return entries
+
+
+def query(sql, path=STORE_FILE):
+    conn = connect(path)
+    cur  = conn.execute(sql)
+    if cur.description:
+        print('\t'.join(c[0] for c in cur.description))
+        for row in cur.fetchall():
+            print('\t'.join('' if v is None else str(v) for v in row))
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Results store')
+    parser.add_argument('command', choices=['ingest', 'query'])
+    parser.add_argument('sql',     nargs='?')
+    parser.add_argument('--store', default=STORE_FILE)
+    parser.add_argument('--force', action='store_true')
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('store', args)
+
+    if args.command == 'ingest':
+        ingest(args.store, force=args.force, samples=registry.selection(args))
+    else:
+        query(args.sql, args.store)
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import argparse
 import pandas as pd
 from pathlib import Path
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+import registry
+import profiling
+from plots import deamination_totals
+
 col_substitutions = ['G>A','C>T', 'A>G', 'T>C', 'A>C', 'A>T', 'C>G', 'C>A', 'T>G', 'T>A', 'G>C', 'G>T', 'A>-', 'T>-', 'C>-', 'G>-', '->A', '->T', '->C', '->G', 'S']
 
-def analyze():
+def analyze(samples=None):
     data_dir = Path("01_data")
     results = []
     
-    sample_dirs = [d for d in data_dir.iterdir() if d.is_dir()]
+    sample_dirs = [d for d in data_dir.iterdir() if d.is_dir() and registry.selected(d.name, samples)]
     
     for sample_dir in sample_dirs:
         sample_name = sample_dir.name
@@ -20,69 +28,63 @@ def analyze():
             
         try:
             df = pd.read_csv(misincorp_file, sep='\t')
-            
-            mask = (df['Pos'] <= 25) & (df['End'].isin(['3p', '5p']))
-            df_filtered = df[mask].copy()
-            
-            if df_filtered.empty:
+            df = df[(df['Pos'] <= 25) & (df['End'].isin(['3p', '5p']))]
+
+            if df.empty:
                 continue
-            
-            for end in ['3p', '5p']:
-                end_data = df_filtered[df_filtered['End'] == end]
-                
-                if end_data.empty:
-                    continue
-                
-                for pos in range(1, 26):
-                    pos_data = end_data[end_data['Pos'] == pos]
-                    
-                    if len(pos_data) != 2:
+
+            # summed over every reference like the plots and the store, mapDamage writes one block per Chr
+            combined = deamination_totals(df)
+            strands  = df.drop(columns=['Chr'], errors='ignore').groupby(['Std', 'End', 'Pos']).sum()
+
+            for (end, pos), row in combined.iterrows():
+                pos_strand = strands.loc[('+', end, pos)] if ('+', end, pos) in strands.index else None
+                neg_strand = strands.loc[('-', end, pos)] if ('-', end, pos) in strands.index else None
+
+                for sub_type in col_substitutions:
+                    if sub_type not in row.index:
                         continue
-                    
-                    pos_strand = pos_data[pos_data['Std'] == '+'].iloc[0] if len(pos_data[pos_data['Std'] == '+']) > 0 else None
-                    neg_strand = pos_data[pos_data['Std'] == '-'].iloc[0] if len(pos_data[pos_data['Std'] == '-']) > 0 else None
-                    
-                    if pos_strand is None or neg_strand is None:
+                    pos_count       = pos_strand[sub_type] if pos_strand is not None else 0
+                    neg_count       = neg_strand[sub_type] if neg_strand is not None else 0
+                    total_pos_count = pos_strand['Total'] if pos_strand is not None else 0
+                    total_neg_count = neg_strand['Total'] if neg_strand is not None else 0
+                    combined_count  = row[sub_type]
+                    combined_total  = row['Total']
+
+                    if combined_total == 0:
                         continue
-                    
-                    for sub_type in col_substitutions:
-                        pos_count       = pos_strand[sub_type]
-                        neg_count       = neg_strand[sub_type]
-                        total_pos_count = pos_strand['Total']
-                        total_neg_count = neg_strand['Total']
-                        combined_count  = pos_count + neg_count
-                        combined_total  = total_pos_count + total_neg_count
-                        
-                        if combined_total == 0:
-                            continue
-                        
-                        frequency = combined_count / combined_total
-                        
-                        results.append({
-                            'Sample'         : sample_name,
-                            'End'            : end,
-                            'Position'       : pos,
-                            'Substitution'   : sub_type,
-                            'Pos_Count'      : pos_count,
-                            'Neg_Count'      : neg_count,
-                            'Combined_Count' : combined_count,
-                            'Pos_Total'      : total_pos_count,
-                            'Neg_Total'      : total_neg_count,
-                            'Combined_Total' : combined_total,
-                            'Frequency'      : frequency
-                        })
-                    
+
+                    frequency = combined_count / combined_total
+
+                    results.append({
+                        'Sample'         : sample_name,
+                        'End'            : end,
+                        'Position'       : pos,
+                        'Substitution'   : sub_type,
+                        'Pos_Count'      : pos_count,
+                        'Neg_Count'      : neg_count,
+                        'Combined_Count' : combined_count,
+                        'Pos_Total'      : total_pos_count,
+                        'Neg_Total'      : total_neg_count,
+                        'Combined_Total' : combined_total,
+                        'Frequency'      : frequency
+                    })
+
         except Exception as e:
             continue
     
     return results
 
-def save_results(results):
+# a --samples/--types run replaces only its own samples' rows, the maxima are redone over the whole table
+def save_results(results, samples=None):
+    csv_filename = "03_results/frequencies.csv"
+    if samples is not None and os.path.exists(csv_filename):
+        old     = pd.read_csv(csv_filename)
+        results = old[~old['Sample'].astype(str).isin(samples)].to_dict('records') + results
     if not results:
         return
     
     csv_df = pd.DataFrame(results)
-    csv_filename = "03_results/frequencies.csv"
     csv_df.to_csv(csv_filename, index=False)
     
     max_results = []
@@ -109,8 +111,17 @@ def save_results(results):
     max_df.to_csv(max_csv_filename, index=False)
 
 def main():
-    results = analyze()
-    save_results(results)
+    parser = argparse.ArgumentParser(description='Per position substitution frequencies from the mapDamage outputs')
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('createcsv', args)
+    samples = registry.selection(args)
+    with profiling.stage('analyze', unit='rows') as rec:
+        results = analyze(samples)
+        rec['items'] = len(results)
+    with profiling.stage('save'):
+        save_results(results, samples)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,17 +1,32 @@
 import os
 import sys
-import glob
 import json
+import time
+import argparse
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+from discovery import load_index
+from ledger import Ledger
+from resources import ResourceMonitor
+import registry
+import profiling
+
+# mapDamage2.0 on every nuclear postSample bam. the pipeline gets misincorporation.txt from
+# 03_inserts/scan.py now, which writes the same table in the pass it already makes for the
+# inserts. this stays as the reference it's checked against (scan.py --check) and for the
+# fragment misincorporation plots mapDamage draws, it writes to the same deamination/<sample>/
 class Damage:
-    def __init__(self):
-        self.files_bam   = glob.glob(os.path.join('*', 'transrate2', 'nuclear', '*.postSample.sorted.bam'))
-        self.files_fasta = glob.glob(os.path.join('*', '*.fa'))
+    def __init__(self, samples=None):
+        index            = load_index()
+        self.files_bam   = [f for f in index.bams(organelles=['nuclear'], suffix='.postSample.sorted.bam')
+                            if registry.selected(f.split('/')[0], samples)]
+        self.files_fasta = index.fastas()
 
         self.dir_output = 'deamination'
         self.done_count = 0
+        self.ledger     = Ledger()
         os.makedirs(self.dir_output, exist_ok=True)
 
         self.sample_files = {}
@@ -32,7 +47,17 @@ class Damage:
         fasta_file = files['fasta']
 
         command = f"mapDamage -i {bam_file} -r {fasta_file} -d {output} --merge-libraries"
-        results = subprocess.run(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with profiling.stage('mapdamage', sample, unit='MB', items=os.path.getsize(bam_file) / 1024 ** 2) as rec:
+            start   = time.time()
+            results = subprocess.Popen(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            monitor = ResourceMonitor(results.pid)
+            results.wait()
+            status  = 'done' if results.returncode == 0 else 'failed'
+            usage   = monitor.stop()
+            # the monitor sees mapDamage's whole process tree, the other threads' jobs don't leak in
+            rec.update(cpu=usage['cpu'], peak_rss=usage['peak_rss'], returncode=results.returncode)
+        self.ledger.record(sample, 'nuclear', 'mapdamage', status, [bam_file, fasta_file],
+                           start=start, end=time.time(), resources=usage)
         if results.returncode != 0:
             print(f"Error running mapDamage2.0 for {sample}")
             sys.exit()
@@ -40,12 +65,17 @@ class Damage:
         print(f"{self.done_count} / {len(self.sample_files)} -- {sample}")
 
     def mapDamage_threading(self):
-        threads = len(self.sample_files)
+        threads = max(1, len(self.sample_files))
         with ThreadPoolExecutor(max_workers=threads) as executor:
             futures = [executor.submit(self.run_mapdamage, sample, files) for sample, files in self.sample_files.items()]
             for future in futures:
                 future.result()
 
 if __name__ == '__main__':
-    damage = Damage()
+    parser = argparse.ArgumentParser(description='mapDamage2.0 on every nuclear postSample bam')
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('mapdamage', args)
+    damage = Damage(registry.selection(args))
     damage.mapDamage_threading()
\ No newline at end of file
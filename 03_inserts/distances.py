@@ -20,21 +20,115 @@ mate total length: 18                                 |________________|
 
 import os
 import sys
+import argparse
 import pandas as pd
 import numpy as np
 import pysam
-import glob
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing as mp
 from tqdm import tqdm
 import psutil
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+from discovery import load_index
+import registry
+import profiling
+
+PANDAS_COLUMNS = ['ref_name', 'read_name', 'read_start', 'read_end', 'mate_start', 'mate_end',
+                  'read_length', 'mate_length', 'insert_length', 'overlap_length']
+
+
+def read_pairs(reads):
+    reads_by_name = {}
+    for read in reads:
+        if not read.is_proper_pair:
+            continue
+        reads_by_name.setdefault(read.query_name, []).append(read)
+
+    n_pairs = sum(1 for v in reads_by_name.values() if len(v) == 2)
+    data = {
+        'ref_name'      : np.empty(n_pairs, dtype=object),
+        'read_name'     : np.empty(n_pairs, dtype=object),
+        'read_start'    : np.zeros(n_pairs, dtype=np.int32),
+        'read_end'      : np.zeros(n_pairs, dtype=np.int32),
+        'mate_start'    : np.zeros(n_pairs, dtype=np.int32),
+        'mate_end'      : np.zeros(n_pairs, dtype=np.int32),
+        'read_length'   : np.zeros(n_pairs, dtype=np.int32),
+        'mate_length'   : np.zeros(n_pairs, dtype=np.int32),
+        'insert_length' : np.zeros(n_pairs, dtype=np.int32),
+        'overlap_length': np.zeros(n_pairs, dtype=np.int32)
+    }
+
+    valid_count = 0
+    for read_name, pair in reads_by_name.items():
+        read1s = [r for r in pair if r.is_read1]
+        read2s = [r for r in pair if r.is_read2]
+        if len(read1s) != 1 or len(read2s) != 1:
+            continue
+        read = read1s[0]
+        mate = read2s[0]
+
+        read_soft_start     = read.query_alignment_start
+        read_soft_end       = read.query_length - read.query_alignment_end
+        mate_soft_start     = mate.query_alignment_start
+        mate_soft_end       = mate.query_length - mate.query_alignment_end
+
+        read_total_length   = read.query_alignment_length + read_soft_start + read_soft_end
+        mate_total_length   = mate.query_alignment_length + mate_soft_start + mate_soft_end
+
+        read_adjusted_start = read.reference_start - read_soft_start
+        read_adjusted_end   = read.reference_end + read_soft_end
+        mate_adjusted_start = mate.reference_start - mate_soft_start
+        mate_adjusted_end   = mate.reference_end + mate_soft_end
+
+        read_start = min(read_adjusted_start, read_adjusted_end)
+        read_end   = max(read_adjusted_start, read_adjusted_end)
+        mate_start = min(mate_adjusted_start, mate_adjusted_end)
+        mate_end   = max(mate_adjusted_start, mate_adjusted_end)
+
+        if read_end < mate_start:
+            insert_length = mate_start - read_end
+            overlap_length = 0
+        elif mate_end < read_start:
+            insert_length = read_start - mate_end
+            overlap_length = 0
+        else:
+            insert_length = 0
+            overlap_length = min(read_end, mate_end) - max(read_start, mate_start)
+
+        if (read.reference_start > read.reference_end) != (mate.reference_start > mate.reference_end):
+            insert_length = -insert_length
+
+        if 'N' in read.cigarstring or 'N' in mate.cigarstring:
+            continue
+
+        if abs(read.reference_start - mate.reference_start) > 1000:
+            continue
+
+        data['ref_name'][valid_count]       = read.reference_name
+        data['read_name'][valid_count]      = read.query_name
+        data['read_start'][valid_count]     = read_adjusted_start
+        data['read_end'][valid_count]       = read_adjusted_end
+        data['mate_start'][valid_count]     = mate_adjusted_start
+        data['mate_end'][valid_count]       = mate_adjusted_end
+        data['read_length'][valid_count]    = read_total_length
+        data['mate_length'][valid_count]    = mate_total_length
+        data['insert_length'][valid_count]  = insert_length
+        data['overlap_length'][valid_count] = overlap_length
+
+        valid_count += 1
+
+    if valid_count > 0:
+        return pd.DataFrame({k: v[:valid_count] for k, v in data.items()})
+    return pd.DataFrame(columns=PANDAS_COLUMNS)
+
+
 class ReadDistance:
-    def __init__(self):
-        self.files_bam      = glob.glob("**/*sorted.bam", recursive=True)
-        self.index_files    = glob.glob("**/*sorted.bam.bai", recursive=True)
-        self.pandas_columns = ['ref_name', 'read_name', 'read_start', 'read_end', 'mate_start', 'mate_end', 
-                               'read_length', 'mate_length', 'insert_length', 'overlap_length']
+    def __init__(self, samples=None):
+        index               = load_index()
+        self.files_bam      = [f for f in index.bams() if registry.selected(f.split('/')[0], samples)]
+        self.index_files    = [f'{f}.bai' for f in self.files_bam if os.path.exists(f'{f}.bai')]
+        self.pandas_columns = PANDAS_COLUMNS
         self.save_dir         = 'read_distance'
         total_memory          = psutil.virtual_memory().total
         self.max_workers      = min(mp.cpu_count() - 1, max(1, int(total_memory / (1024 * 1024 * 1024))))
@@ -48,88 +142,7 @@ class ReadDistance:
         print(f"Batch size: {self.batch_size} reads per batch")
 
     def process_read_batch(self, reads, bam):
-        reads_by_name = {}
-        for read in reads:
-            if not read.is_proper_pair:
-                continue
-            reads_by_name.setdefault(read.query_name, []).append(read)
-
-        n_pairs = sum(1 for v in reads_by_name.values() if len(v) == 2)
-        data = {
-            'ref_name'      : np.empty(n_pairs, dtype=object),
-            'read_name'     : np.empty(n_pairs, dtype=object),
-            'read_start'    : np.zeros(n_pairs, dtype=np.int32),
-            'read_end'      : np.zeros(n_pairs, dtype=np.int32),
-            'mate_start'    : np.zeros(n_pairs, dtype=np.int32),
-            'mate_end'      : np.zeros(n_pairs, dtype=np.int32),
-            'read_length'   : np.zeros(n_pairs, dtype=np.int32),
-            'mate_length'   : np.zeros(n_pairs, dtype=np.int32),
-            'insert_length' : np.zeros(n_pairs, dtype=np.int32),
-            'overlap_length': np.zeros(n_pairs, dtype=np.int32)
-        }
-
-        valid_count = 0
-        for read_name, pair in reads_by_name.items():
-            read1s = [r for r in pair if r.is_read1]
-            read2s = [r for r in pair if r.is_read2]
-            if len(read1s) != 1 or len(read2s) != 1:
-                continue
-            read = read1s[0]
-            mate = read2s[0]
-
-            read_soft_start     = read.query_alignment_start
-            read_soft_end       = read.query_length - read.query_alignment_end
-            mate_soft_start     = mate.query_alignment_start
-            mate_soft_end       = mate.query_length - mate.query_alignment_end
-
-            read_total_length   = read.query_alignment_length + read_soft_start + read_soft_end
-            mate_total_length   = mate.query_alignment_length + mate_soft_start + mate_soft_end
-
-            read_adjusted_start = read.reference_start - read_soft_start
-            read_adjusted_end   = read.reference_end + read_soft_end
-            mate_adjusted_start = mate.reference_start - mate_soft_start
-            mate_adjusted_end   = mate.reference_end + mate_soft_end
-
-            read_start = min(read_adjusted_start, read_adjusted_end)
-            read_end   = max(read_adjusted_start, read_adjusted_end)
-            mate_start = min(mate_adjusted_start, mate_adjusted_end)
-            mate_end   = max(mate_adjusted_start, mate_adjusted_end)
-
-            if read_end < mate_start:
-                insert_length = mate_start - read_end
-                overlap_length = 0
-            elif mate_end < read_start:
-                insert_length = read_start - mate_end
-                overlap_length = 0
-            else:
-                insert_length = 0
-                overlap_length = min(read_end, mate_end) - max(read_start, mate_start)
-
-            if (read.reference_start > read.reference_end) != (mate.reference_start > mate.reference_end):
-                insert_length = -insert_length
-
-            if 'N' in read.cigarstring or 'N' in mate.cigarstring:
-                continue
-
-            if abs(read.reference_start - mate.reference_start) > 1000:
-                continue
-
-            data['ref_name'][valid_count]       = read.reference_name
-            data['read_name'][valid_count]      = read.query_name
-            data['read_start'][valid_count]     = read_adjusted_start
-            data['read_end'][valid_count]       = read_adjusted_end
-            data['mate_start'][valid_count]     = mate_adjusted_start
-            data['mate_end'][valid_count]       = mate_adjusted_end
-            data['read_length'][valid_count]    = read_total_length
-            data['mate_length'][valid_count]    = mate_total_length
-            data['insert_length'][valid_count]  = insert_length
-            data['overlap_length'][valid_count] = overlap_length
-
-            valid_count += 1
-
-        if valid_count > 0:
-            return pd.DataFrame({k: v[:valid_count] for k, v in data.items()})
-        return pd.DataFrame(columns=self.pandas_columns)
+        return read_pairs(reads)
 
     def process_reference_batch(self, file_bam, references):
         try:
@@ -172,40 +185,49 @@ class ReadDistance:
                 continue
                 
             print(f'\nProcessing file: {file_bam}')
+            with profiling.stage('inserts', bam_name, unit='reads') as rec:
+                self.read_distance(file_bam, output_file, rec)
+
+    def read_distance(self, file_bam, output_file, rec):
+        with pysam.AlignmentFile(file_bam, "rb") as bam:
+            references   = bam.references
+            rec['items'] = sum(s.total for s in bam.get_index_statistics())
+        
+        ref_batches = [references[i:i + self.refs_per_process] 
+                     for i in range(0, len(references), self.refs_per_process)]
+        
+        all_results = []
+        
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_batch = {
+                executor.submit(self.process_reference_batch, file_bam, batch): batch 
+                for batch in ref_batches
+            }
             
-            with pysam.AlignmentFile(file_bam, "rb") as bam:
-                references = bam.references
-            
-            ref_batches = [references[i:i + self.refs_per_process] 
-                         for i in range(0, len(references), self.refs_per_process)]
-            
-            all_results = []
-            
-            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
-                future_to_batch = {
-                    executor.submit(self.process_reference_batch, file_bam, batch): batch 
-                    for batch in ref_batches
-                }
-                
-                with tqdm(total=len(ref_batches), desc="Processing reference batches", unit="batch") as pbar:
-                    for future in as_completed(future_to_batch):
-                        batch = future_to_batch[future]
-                        try:
-                            result_df = future.result()
-                            if not result_df.empty:
-                                all_results.append(result_df)
-                        except Exception as e:
-                            print(f"\nError processing batch {batch}: {str(e)}")
-                        pbar.update(1)
-            
-            if all_results:
-                final_df = pd.concat(all_results, ignore_index=True)
-                final_df.to_csv(output_file, index=False)
-                print(f"\nSaved {len(final_df)} processed reads to {output_file}")
-            else:
-                print(f"\nNo valid reads found in {file_bam}")
+            with tqdm(total=len(ref_batches), desc="Processing reference batches", unit="batch") as pbar:
+                for future in as_completed(future_to_batch):
+                    batch = future_to_batch[future]
+                    try:
+                        result_df = future.result()
+                        if not result_df.empty:
+                            all_results.append(result_df)
+                    except Exception as e:
+                        print(f"\nError processing batch {batch}: {str(e)}")
+                    pbar.update(1)
+        
+        if all_results:
+            final_df = pd.concat(all_results, ignore_index=True)
+            final_df.to_csv(output_file, index=False)
+            print(f"\nSaved {len(final_df)} processed reads to {output_file}")
+        else:
+            print(f"\nNo valid reads found in {file_bam}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Insert lengths of the proper pairs in each bam')
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('inserts', args)
     mp.set_start_method('spawn')
-    read_distance = ReadDistance()
+    read_distance = ReadDistance(registry.selection(args))
     read_distance.get_read_distance()
\ No newline at end of file
@@ -0,0 +1,337 @@
+'''
+Single pass over each postSample.sorted.bam that produces both the insert
+table (same as distances.py) and a mapDamage style misincorporation.txt.
+
+Each worker opens the bam once for its shard of references and hands every
+record to the accumulators that still have outputs to write. So if
+read_distance/<sample>.csv already exists only the damage tallies are run,
+and the other way around.
+
+damage tallies are merged over all references (one set of rows per End/Std/Pos)
+which is what plots.parse_deamination and createcsv.py read anyway. They follow
+mapDamage's counting: positions run over alignment columns, so an insertion
+takes a position like an aligned base, and S at position i counts reads with
+more than i soft clipped bases at that end. 03_deamination/damage.py still
+runs mapDamage itself, --check compares the two on one bam:
+
+    python scan.py --check small.bam ref.fa mapdamage_out/misincorporation.txt
+
+'''
+
+import os
+import sys
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import pysam
+import psutil
+from tqdm import tqdm
+from distances import PANDAS_COLUMNS, read_pairs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+from discovery import load_index
+import registry
+import profiling
+
+DAMAGE_LENGTH  = 25
+DAMAGE_BASES   = ['A', 'C', 'G', 'T']
+DAMAGE_SUBS    = ['G>A', 'C>T', 'A>G', 'T>C', 'A>C', 'A>T', 'C>G', 'C>A', 'T>G', 'T>A', 'G>C', 'G>T',
+                  'A>-', 'T>-', 'C>-', 'G>-', '->A', '->T', '->C', '->G', 'S']
+DAMAGE_COLUMNS = DAMAGE_BASES + DAMAGE_SUBS
+DAMAGE_INDEX   = {c: i for i, c in enumerate(DAMAGE_COLUMNS)}
+COMPLEMENT     = str.maketrans('ACGTN', 'TGCAN')
+
+
+# collects reads for the current reference and pairs them the same way ReadDistance does
+class InsertAccumulator:
+    name = 'inserts'
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.reads      = []
+        self.batches    = []
+
+    def begin_reference(self, reference, sequence):
+        self.reads = []
+
+    def add(self, read):
+        self.reads.append(read)
+
+    def end_reference(self, reference):
+        for i in range(0, len(self.reads), self.batch_size):
+            batch_df = read_pairs(self.reads[i:i + self.batch_size])
+            if not batch_df.empty:
+                self.batches.append(batch_df)
+        self.reads = []
+
+    def result(self):
+        if self.batches:
+            return pd.concat(self.batches, ignore_index=True)
+        return pd.DataFrame(columns=PANDAS_COLUMNS)
+
+    @staticmethod
+    def merge(results):
+        results = [r for r in results if not r.empty]
+        if results:
+            return pd.concat(results, ignore_index=True)
+        return pd.DataFrame(columns=PANDAS_COLUMNS)
+
+    @staticmethod
+    def write(result, path):
+        if result.empty:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        result.to_csv(path, index=False)
+        return True
+
+
+# terminal substitution counts against the reference, laid out like mapDamage.
+# counts[end, strand, pos, column] with end 0=5p 1=3p, strand 0=+ 1=-
+class DamageAccumulator:
+    name = 'damage'
+
+    def __init__(self, batch_size):
+        self.counts   = np.zeros((2, 2, DAMAGE_LENGTH, len(DAMAGE_COLUMNS)), dtype=np.int64)
+        self.sequence = None
+
+    def begin_reference(self, reference, sequence):
+        self.sequence = sequence
+
+    def add(self, read):
+        if read.is_unmapped or read.is_secondary or read.is_supplementary or self.sequence is None:
+            return
+        query  = read.query_sequence
+        if query is None:
+            return
+        query  = query.upper()
+        strand = 1 if read.is_reverse else 0
+
+        # only the DAMAGE_LENGTH aligned columns at each end of the alignment are walked, read in
+        # its own 5'->3' direction. reverse reads are complemented, their 5' end is the right one
+        left  = list(self.columns(read, query, reverse=False))
+        right = list(self.columns(read, query, reverse=True))
+        if strand:
+            left, right = ([(r.translate(COMPLEMENT), b.translate(COMPLEMENT)) for r, b in cols]
+                           for cols in (right, left))
+
+        clip_5p = read.query_alignment_start if not strand else read.query_length - read.query_alignment_end
+        clip_3p = read.query_length - read.query_alignment_end if not strand else read.query_alignment_start
+
+        self.tally(0, strand, left, clip_5p)
+        self.tally(1, strand, right, clip_3p)
+
+    # (ref, base) per alignment column from one end inwards, like get_aligned_pairs without the
+    # clips: an insertion is a column with ref '-', a deletion or skip one with base '-'
+    def columns(self, read, query, reverse):
+        cigar = reversed(read.cigartuples) if reverse else read.cigartuples
+        step  = -1 if reverse else 1
+        qpos  = read.query_alignment_end - 1 if reverse else read.query_alignment_start
+        rpos  = read.reference_end - 1 if reverse else read.reference_start
+        count = 0
+        for op, length in cigar:
+            if op in (4, 5, 6):             # soft/hard clip, padding
+                continue
+            for _ in range(length):
+                if count == DAMAGE_LENGTH:
+                    return
+                if op == 1:                 # insertion
+                    yield '-', query[qpos]
+                    qpos += step
+                elif op in (2, 3):          # deletion, skipped region
+                    yield self.sequence[rpos], '-'
+                    rpos += step
+                else:                       # M, =, X
+                    yield self.sequence[rpos], query[qpos]
+                    qpos += step
+                    rpos += step
+                count += 1
+
+    def tally(self, end, strand, columns, clipped):
+        counts = self.counts[end, strand]
+        for pos in range(min(clipped, DAMAGE_LENGTH)):
+            counts[pos, DAMAGE_INDEX['S']] += 1
+        for pos, (ref, base) in enumerate(columns):
+            if ref in 'ACGT':
+                counts[pos, DAMAGE_INDEX[ref]] += 1
+            key = f'{ref}>{base}'
+            if ref != base and key in DAMAGE_INDEX:
+                counts[pos, DAMAGE_INDEX[key]] += 1
+
+    def end_reference(self, reference):
+        self.sequence = None
+
+    def result(self):
+        return self.counts
+
+    @staticmethod
+    def merge(results):
+        return sum(results[1:], results[0].copy()) if results else None
+
+    @staticmethod
+    def write(result, path):
+        if result is None or not result.any():
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        DamageAccumulator.table(result).to_csv(path, sep='\t', index=False)
+        return True
+
+    @staticmethod
+    def table(result):
+        rows = []
+        for e, end in enumerate(('5p', '3p')):
+            for s, std in enumerate(('+', '-')):
+                for pos in range(DAMAGE_LENGTH):
+                    counts = result[e, s, pos]
+                    bases  = counts[:len(DAMAGE_BASES)]
+                    rows.append(['*', end, std, pos + 1, *bases.tolist(), int(bases.sum()),
+                                 *counts[len(DAMAGE_BASES):].tolist()])
+        columns = ['Chr', 'End', 'Std', 'Pos'] + DAMAGE_BASES + ['Total'] + DAMAGE_SUBS
+        return pd.DataFrame(rows, columns=columns)
+
+
+ACCUMULATORS = {
+    InsertAccumulator.name: InsertAccumulator,
+    DamageAccumulator.name: DamageAccumulator,
+}
+
+
+# worker, one bam handle for the whole shard and every record goes to every accumulator
+def scan_shard(file_bam, file_fasta, references, names, batch_size):
+    accumulators = [ACCUMULATORS[n](batch_size) for n in names]
+    fasta        = pysam.FastaFile(file_fasta) if file_fasta else None
+    with pysam.AlignmentFile(file_bam, "rb") as bam:
+        for reference in references:
+            sequence = None
+            if fasta is not None and reference in fasta.references:
+                sequence = fasta.fetch(reference).upper()
+            for acc in accumulators:
+                acc.begin_reference(reference, sequence)
+            try:
+                for read in bam.fetch(reference=reference):
+                    for acc in accumulators:
+                        acc.add(read)
+            except Exception as e:
+                print(f"\nError processing reference {reference}: {str(e)}")
+            for acc in accumulators:
+                acc.end_reference(reference)
+    if fasta is not None:
+        fasta.close()
+    return {acc.name: acc.result() for acc in accumulators}
+
+
+# damage tallies of one bam against a misincorporation.txt mapDamage wrote for it, summed over
+# references and cut to DAMAGE_LENGTH since mapDamage keeps one set of rows per Chr and 70 positions
+def check_damage(file_bam, file_fasta, misincorporation):
+    with pysam.AlignmentFile(file_bam, "rb") as bam:
+        references = bam.references
+    ours   = DamageAccumulator.table(scan_shard(file_bam, file_fasta, references, ['damage'], 1)['damage'])
+    theirs = pd.read_csv(misincorporation, sep='\t', comment='#')
+    theirs = theirs[theirs['Pos'] <= DAMAGE_LENGTH]
+    keys   = ['End', 'Std', 'Pos']
+    shared = [c for c in DAMAGE_COLUMNS + ['Total'] if c in theirs.columns]
+    ours   = ours.groupby(keys)[shared].sum()
+    theirs = theirs.groupby(keys)[shared].sum().reindex(ours.index, fill_value=0)
+    diff   = ours.ne(theirs)
+    for (end, std, pos), row in diff[diff.any(axis=1)].iterrows():
+        cols = [c for c in shared if row[c]]
+        print(f"{end} {std} {pos}: " + ', '.join(f"{c} {ours.loc[(end, std, pos), c]} vs {theirs.loc[(end, std, pos), c]}"
+                                                for c in cols))
+    print(f"{int(diff.values.sum())} of {diff.size} counts differ from mapDamage")
+    return not diff.values.any()
+
+
+class BamScanner:
+    def __init__(self, samples=None, workers=None):
+        index            = load_index()
+        self.files_bam   = index.bams(organelles=['nuclear'], suffix='.postSample.sorted.bam')
+        self.files_fasta = index.fastas()
+        self.dir_inserts = 'read_distance'
+        self.dir_damage  = 'deamination'
+
+        total_memory          = psutil.virtual_memory().total
+        self.max_workers      = workers or min(mp.cpu_count() - 1, max(1, int(total_memory / (1024 * 1024 * 1024))))
+        available_memory      = psutil.virtual_memory().available
+        self.batch_size       = min(10000, max(1000, int(available_memory / (1024 * 1024 * 10))))
+        self.refs_per_process = max(1, min(10, int(available_memory / (1024 * 1024 * 100))))
+
+        fastas = {f.split('/')[-1].split('.')[0]: f for f in self.files_fasta}
+        self.sample_files = {}
+        for file_bam in sorted(self.files_bam):
+            sample_name = file_bam.split('/')[-1].split('.')[0]
+            # --samples are sample directories, the bam is named after the sample too but may differ (_paired)
+            if not registry.selected(file_bam.split('/')[0], samples):
+                continue
+            self.sample_files[sample_name] = {'bam': file_bam, 'fasta': fastas.get(sample_name)}
+
+        print(f"Using {self.max_workers} workers")
+        print(f"References per process: {self.refs_per_process}")
+
+    def outputs(self, sample):
+        return {
+            'inserts': os.path.join(self.dir_inserts, f'{sample}.csv'),
+            'damage' : os.path.join(self.dir_damage, sample, 'misincorporation.txt'),
+        }
+
+    def scan_sample(self, sample, files, executor):
+        outputs = self.outputs(sample)
+        names   = [n for n, path in outputs.items() if not os.path.exists(path)]
+        if 'damage' in names and not files.get('fasta'):
+            print(f"No reference fasta for {sample}, skipping damage")
+            names.remove('damage')
+        if not names:
+            print(f'\nSkipping {files["bam"]} - outputs already exist')
+            return
+
+        print(f'\nScanning {files["bam"]} for {", ".join(names)}')
+        with profiling.stage('scan', sample, unit='reads', outputs=names) as rec:
+            self.scan_outputs(sample, files, executor, outputs, names, rec)
+
+    def scan_outputs(self, sample, files, executor, outputs, names, rec):
+        with pysam.AlignmentFile(files['bam'], "rb") as bam:
+            references   = bam.references
+            rec['items'] = sum(s.total for s in bam.get_index_statistics())
+        shards = [references[i:i + self.refs_per_process]
+                  for i in range(0, len(references), self.refs_per_process)]
+
+        results = {n: [] for n in names}
+        futures = {executor.submit(scan_shard, files['bam'], files.get('fasta'), shard, names, self.batch_size): shard
+                   for shard in shards}
+        with tqdm(total=len(shards), desc="Scanning reference shards", unit="shard") as pbar:
+            for future in as_completed(futures):
+                try:
+                    for name, result in future.result().items():
+                        results[name].append(result)
+                except Exception as e:
+                    print(f"\nError processing shard {futures[future]}: {str(e)}")
+                pbar.update(1)
+
+        for name in names:
+            merged = ACCUMULATORS[name].merge(results[name])
+            if ACCUMULATORS[name].write(merged, outputs[name]):
+                print(f"Saved {name} to {outputs[name]}")
+            else:
+                print(f"No {name} results for {sample}")
+
+    def run(self):
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            for sample, files in self.sample_files.items():
+                self.scan_sample(sample, files, executor)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inserts and damage tallies in one pass over each bam')
+    parser.add_argument('--workers', type=int, default=None)   # shard processes, default from cpu and memory
+    parser.add_argument('--check',   nargs=3, default=None,     # bam, fasta, mapDamage misincorporation.txt
+                        metavar=('BAM', 'FASTA', 'MISINCORPORATION'))
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if check_damage(*args.check) else 1)
+    profiling.setup('scan', args)
+
+    mp.set_start_method('spawn')
+    scanner = BamScanner(registry.selection(args), args.workers)
+    scanner.run()
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+from constants import DATA_DIR, CONTIG_SCORE_COLS, CONTIG_BINS, CONTIG_QUANTILES
+from discovery import SampleIndex
+import registry
+import profiling
+
+# streams each sample's transrate2 contigs.csv in chunks and keeps only a fixed
+# histogram per score column, so memory is the same for 1k or 10M contigs.
+# quantiles are read back off the histogram (linear inside a bin).
+
+CHUNK_SIZE = 250_000
+
+
+def histogram_quantiles(counts, edges, qs):
+    total = counts.sum()
+    if total == 0:
+        return {str(q): None for q in qs}
+    cum = np.concatenate([[0], np.cumsum(counts)])
+    out = {}
+    for q in qs:
+        target = q * total
+        i      = min(max(int(np.searchsorted(cum, target, side='left')) - 1, 0), len(counts) - 1)
+        inside = (target - cum[i]) / counts[i] if counts[i] else 0.0
+        out[str(q)] = float(edges[i] + inside * (edges[i + 1] - edges[i]))
+    return out
+
+
+def summarise(sample, path):
+    edges   = np.linspace(0.0, 1.0, CONTIG_BINS + 1)
+    header  = pd.read_csv(path, nrows=0).columns
+    columns = [c for c in CONTIG_SCORE_COLS if c in header]
+    stats   = {c: {'counts': np.zeros(CONTIG_BINS, dtype=np.int64), 'n': 0, 'missing': 0,
+                   'sum': 0.0, 'min': np.inf, 'max': -np.inf} for c in columns}
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=CHUNK_SIZE):
+        rows += len(chunk)
+        for c in columns:
+            vals = pd.to_numeric(chunk[c], errors='coerce').to_numpy(dtype=np.float64)
+            ok   = ~np.isnan(vals)
+            vals = vals[ok]
+            s    = stats[c]
+            s['missing'] += int((~ok).sum())
+            if not len(vals):
+                continue
+            s['n']   += len(vals)
+            s['sum'] += float(vals.sum())
+            s['min']  = min(s['min'], float(vals.min()))
+            s['max']  = max(s['max'], float(vals.max()))
+            bins      = np.clip(np.floor(vals * CONTIG_BINS).astype(np.int64), 0, CONTIG_BINS - 1)
+            s['counts'] += np.bincount(bins, minlength=CONTIG_BINS)
+
+    summary = {'sample': sample, 'source': path, 'contigs': rows, 'edges': edges.tolist(), 'scores': {}}
+    for c, s in stats.items():
+        summary['scores'][c] = {
+            'counts'   : s['counts'].tolist(),
+            'n'        : s['n'],
+            'missing'  : s['missing'],
+            'mean'     : s['sum'] / s['n'] if s['n'] else None,
+            'min'      : s['min'] if s['n'] else None,
+            'max'      : s['max'] if s['n'] else None,
+            'quantiles': histogram_quantiles(s['counts'], edges, CONTIG_QUANTILES),
+        }
+    return summary
+
+
+# where plots.py and store.py read a sample's summary, the manifest's transrate_contigs column if it has one
+def summary_path(sample, out_dir=None):
+    if out_dir is None:
+        return registry.load().path(sample, 'transrate_contigs') or os.path.join(DATA_DIR, 'transrate_contigs', f'{sample}.json')
+    return os.path.join(out_dir, f'{sample}.json')
+
+
+def write_summary(sample, path, target):
+    with profiling.stage('contig_stats', sample, unit='contigs') as rec:
+        summary      = summarise(sample, path)
+        rec['items'] = summary['contigs']
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'w') as f:
+        json.dump(summary, f)
+    return sample, summary['contigs']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-contig transrate2 score summaries')
+    parser.add_argument('--root',    default='..')
+    parser.add_argument('--out-dir', default=None)      # default is where plots.py and store.py read them
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    registry.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.setup('contig_stats', args)
+
+    index = SampleIndex(args.root)
+    index.refresh()
+    # sample ids come from the directory the csv is in, not from list order
+    chosen = registry.selection(args)
+    jobs   = {s: os.path.join(args.root, p) for s, paths in index.csvs('nuclear').items() if registry.selected(s, chosen)
+              for p in paths if p.endswith('contigs.csv')}
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(write_summary, s, p, summary_path(s, args.out_dir)) for s, p in sorted(jobs.items())]
+        for future in as_completed(futures):
+            sample, rows = future.result()
+            print(f'{sample:<10}{rows} contigs')
+
+
+if __name__ == '__main__':
+    main()
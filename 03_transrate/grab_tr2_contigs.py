@@ -1,18 +1,21 @@
+import os
+import sys
 import shutil
+import argparse
 from glob import glob
-import sys
 
-samples = ['DAL192','DAL193', 'DAL195', 'DAL212', 'DAL218',
-           'DAL224', 'DAL227', 'WA02', 'WA03', 
-           'WA07', 'WA08', 'WA09', 'WA11', 
-           'WA12', 'WA13', 'WA14', 'WA18', 
-           'WA22', 'WA25', 'WA26']
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+import registry
+
+parser = argparse.ArgumentParser(description='Copy the nuclear transrate2 contigs.csv of each sample')
+registry.add_arguments(parser)
+chosen = registry.selection(parser.parse_args())
 
-csv_assemblies = glob('../*/transrate2/nuclear/contigs.csv')
+csv_assemblies = [x for x in glob('../*/transrate2/nuclear/contigs.csv') if registry.selected(x.split('/')[1], chosen)]
 csv_assemblies.sort()
+# sample name comes from the directory the csv is in, so a missing sample can't shift the labels
 sample_names   = [x.split('/')[1] for x in csv_assemblies]
-sample_names.sort()
-zipped         = zip(samples, csv_assemblies)
+zipped         = zip(sample_names, csv_assemblies)
 data_path      = '01_data/tr2_contigs'
 
 print(len(csv_assemblies))
@@ -3,7 +3,52 @@ import sys
 import json
 import argparse
 import subprocess
+import re
 import shutil
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+from discovery import SampleIndex
+from ledger import Ledger, fingerprint, up_to_date
+from resources import ResourceMonitor, CoreBudget, suggest_threads
+import registry
+import profiling
+
+# first match wins, checked against every line transrate2 writes
+STAGES = [
+    (re.compile(r'salmon|quant', re.I),               'salmon'),
+    (re.compile(r'snap|bowtie|align|mapping', re.I),  'mapping'),
+    (re.compile(r'sampl', re.I),                      'sampling'),
+    (re.compile(r'read metric', re.I),                'read metrics'),
+    (re.compile(r'contig metric|contigs', re.I),      'contig metrics'),
+    (re.compile(r'assembly score|score', re.I),       'scoring'),
+    (re.compile(r'error|panic', re.I),                'error'),
+]
+
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS   = 3
+LOG_TAIL      = 20
+
+def jobLogger(output, stream):
+    logDir = os.path.join(output, 'logs')
+    os.makedirs(logDir, exist_ok=True)
+    # not through getLogger, the manager would keep it (and a placeholder per dotted prefix of the
+    # path) for the life of the process. this one goes away with the job once closeLogger has run
+    logger = logging.Logger(f'transrate2 {output} {stream}', logging.INFO)
+    logger.propagate = False
+    handler = RotatingFileHandler(os.path.join(logDir, f'transrate2.{stream}.log'), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+def closeLogger(logger):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
 class Herbaria:
     def __init__(self):
@@ -16,14 +61,33 @@ class Herbaria:
 
         self.argsSample    :list = []
         self.argsOrganism  :list = []
+        self.onlySamples   :set = None
         self.progress_data :dict = {}
+        self.cores         :int = os.cpu_count() or 1
+        self.maxThreads    :int = 24
+        self.lock          = threading.Lock()
+        self.ledger        = None
+        self.compact       :bool = False
+        self.status        :dict = {}
 
     def parseArgs(self):
         parser = argparse.ArgumentParser(description='Herbaria')
         parser.add_argument('-s', '--sample',   type=str, help='Sample Type (all, dal, wa, none)', default='all')
         parser.add_argument('-o', '--organism', type=str, help='Organelle Type (all, chloro, mito, nuclear, none)', default='all')
         parser.add_argument('-p', '--path',     action='store_true', help='Reiterate File Paths', default=False)
+        parser.add_argument('-c', '--cores',    type=int, help='Total cores shared by all running jobs', default=os.cpu_count() or 1)
+        parser.add_argument('-t', '--threads',  type=int, help='Max threads for a single job', default=24)
+        parser.add_argument('--compact',        action='store_true', help='Convert kept .sam files to sorted, indexed .bam', default=False)
+        registry.add_arguments(parser)
+        profiling.add_arguments(parser)
         args = parser.parse_args()
+        profiling.setup('transrate', args)
+
+        self.compact     = args.compact
+        self.onlySamples = registry.selection(args)
+
+        self.cores      = max(1, args.cores)
+        self.maxThreads = max(1, min(args.threads, self.cores))
 
         if args.path:
             self.pathIter = True
@@ -50,111 +114,216 @@ class Herbaria:
             self.argsOrganism = ['chloro', 'mito', 'nuclear']
 
 
+    # pathDict.json is just a view of the discovery index now, only rescanned samples change it
     def iterateDir(self):
-        if os.path.exists('pathDict.json') and not self.pathIter:
-            self.pathDict = json.load(open('pathDict.json'))
-            return
-        for root, dirs, files in os.walk('.'):
-            for d in dirs:
-                if d.startswith('DAL') or d.startswith('WA'):
-                    self.pathDict[d] = {'assembly': '', 'chloro': [], 'mito': [], 'nuclear': []}
-                    for file in os.listdir(os.path.join(root, d)):
-                        if file.endswith('.cds.fa'):
-                            self.pathDict[d]['assembly'] = file
-                        elif file.startswith('chloro'):
-                            self.pathDict[d]['chloro'].append(file)
-                        elif file.startswith('mito'):
-                            self.pathDict[d]['mito'].append(file)
-                        elif file.startswith('nuclear'):
-                            self.pathDict[d]['nuclear'].append(file)
-        for v in self.pathDict.values():
-            for key in ['chloro', 'mito', 'nuclear']:
-                v[key].sort()
-        with open('pathDict.json', 'w') as json_file:
-            json.dump(self.pathDict, json_file, indent=4)
+        index = SampleIndex()
+        index.refresh(force=self.pathIter)
+        self.pathDict = index.path_dict()
+        if index.changed or not os.path.exists('pathDict.json'):
+            with open('pathDict.json', 'w') as json_file:
+                json.dump(self.pathDict, json_file, indent=4)
 
     def getTotal(self):
-        for k,v in self.pathDict.items():
-            if any(k.startswith(s.upper()) for s in self.argsSample):
-                for key,var in v.items():
-                    if k in self.progress_data and key in self.progress_data[k]:
-                        continue
-                    if key in self.argsOrganism and var:
-                        self.sampleTotal += 1
-                    
-    def iterateRuns(self):
+        self.sampleTotal = len(self.getJobs())
+
+    # finished with the same inputs, a changed fastq or assembly runs again
+    def isDone(self, key, organism, inputs):
+        return (key, organism) in self.progress_data and up_to_date(self.progress_data[key, organism], fingerprint(inputs))
+
+    def getJobs(self):
+        jobs = []
         for key, value in self.pathDict.items():
+            if not registry.selected(key, self.onlySamples):
+                continue
             for sample in self.argsSample:
                 if key.startswith(sample.upper()) and value['assembly'] != '':
                     for organism in self.argsOrganism:
-                        if key in self.progress_data and organism in self.progress_data[key]:
-                            continue
-                        self.sampleCurrent += 1
-                        self.sampleName = key
-                        self.sampleOrganism = organism
-                        output = os.path.join(key, 'transrate2', organism)
-                        assemblyPath = os.path.join(key, value['assembly'])
                         try:
                             leftPath = os.path.join(key, value[organism][0])
                             rightPath = os.path.join(key, value[organism][1])
                         except:
                             continue
-                        keys = [key, organism]
-                        color_codes = {'mito': '91', 'chloro': '92', 'nuclear': '94'}
-                        color_code = color_codes.get(organism, '0')
-                        print(f'{key:<10}\033[{color_code}m{organism:<10}\033[0m', end='\r')
-                        self.transrateRun(assemblyPath, leftPath, rightPath, output, keys)
-                        print(f'{key:<10}\033[{color_code}m{organism:<10}\033[0m{self.sampleCurrent}/{self.sampleTotal}')
-
-    def transrateRun(self, assembly, left, right, output, keys):
-        if not os.path.exists(output):
-            os.makedirs(output)
-        cmd = ['transrate2', '-a', assembly, '-l', left, '-r', right, '-o', output, '-t', str(24), '-s']
-        trRun = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = trRun.communicate()
+                        if self.isDone(key, organism, [os.path.join(key, value['assembly']), leftPath, rightPath]):
+                            continue
+                        size = sum(os.path.getsize(p) for p in (leftPath, rightPath) if os.path.exists(p))
+                        jobs.append({'keys': [key, organism], 'assembly': os.path.join(key, value['assembly']),
+                                     'left': leftPath, 'right': rightPath, 'size': size,
+                                     'output': os.path.join(key, 'transrate2', organism)})
+        # nuclear first then biggest reads first, so the long jobs aren't left for the end
+        jobs.sort(key=lambda j: (j['keys'][1] != 'nuclear', -j['size']))
+        largest = max((j['size'] for j in jobs), default=0)
+        # past runs cap the threads at what that organelle actually kept busy
+        caps    = {o: suggest_threads(self.ledger, 'transrate', o, self.maxThreads) for o in set(j['keys'][1] for j in jobs)}
+        for job in jobs:
+            share = job['size'] / largest if largest else 1
+            job['threads'] = max(1, min(caps[job['keys'][1]], round(self.maxThreads * share)))
+        return jobs
+
+    def iterateRuns(self):
+        jobs   = self.getJobs()
+        budget = CoreBudget(self.cores)
+        with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+            futures = []
+            while jobs:
+                job = budget.take(jobs)
+                futures.append(executor.submit(self.runJob, job, budget))
+            for future in futures:
+                future.result()
+
+    def runJob(self, job, budget):
+        key, organism = job['keys']
+        color_codes = {'mito': '91', 'chloro': '92', 'nuclear': '94'}
+        color_code = color_codes.get(organism, '0')
+        try:
+            # another scheduler may have taken (or finished) this one since we loaded the ledger
+            attempt = self.ledger.claim(key, organism, 'transrate', [job['assembly'], job['left'], job['right']])
+            if attempt is None:
+                self.log(f'{key:<10}\033[{color_code}m{organism:<10}\033[0mskipped (claimed elsewhere)')
+                return
+            self.log(f'{key:<10}\033[{color_code}m{organism:<10}\033[0mstarted ({job["threads"]} threads)')
+            try:
+                with profiling.stage('transrate', key, unit='MB', items=job['size'] / 1024 ** 2,
+                                     organelle=organism, threads=job['threads']) as rec:
+                    resources = self.transrateRun(job['assembly'], job['left'], job['right'], job['output'], job['keys'], job['threads'], attempt)
+                    # transrate2's own process tree, not the other jobs running next to it
+                    rec.update(cpu=resources['cpu'], peak_rss=resources['peak_rss'])
+            except Exception:
+                self.saveProgress(attempt, 'failed')
+                raise
+        finally:
+            budget.release(job['threads'])
+        with self.lock:
+            self.sampleCurrent += 1
+            current = self.sampleCurrent
+        self.log(f'{key:<10}\033[{color_code}m{organism:<10}\033[0m{current}/{self.sampleTotal}')
+
+    # prints above the live status line and redraws it
+    def log(self, msg):
+        with self.lock:
+            sys.stdout.write(f'\r\033[K{msg}\n')
+            self.drawStatus()
+
+    # compare and set under the lock, the stdout and stderr readers of a job both report stages
+    def setStatus(self, keys, stage):
+        with self.lock:
+            if self.status.get(tuple(keys)) == stage:
+                return
+            if stage is None:
+                self.status.pop(tuple(keys), None)
+            else:
+                self.status[tuple(keys)] = stage
+            self.drawStatus()
+
+    def drawStatus(self):
+        width = shutil.get_terminal_size((120, 20)).columns
+        line  = ' | '.join(f'{k}/{o}: {stage}' for (k, o), stage in sorted(self.status.items()))
+        sys.stdout.write(f'\r\033[K{line[:width - 1]}')
+        sys.stdout.flush()
+
+    # reads one pipe line by line into the rotating log, only the last few lines are kept in memory
+    def streamPipe(self, pipe, logger, keys, tail):
+        for line in iter(pipe.readline, ''):
+            line = line.rstrip('\n')
+            logger.info(line)
+            tail.append(line)
+            for pattern, stage in STAGES:
+                if pattern.search(line):
+                    self.setStatus(keys, stage)
+                    break
+        pipe.close()
+
+    def transrateRun(self, assembly, left, right, output, keys, threads=24, attempt=None):
+        os.makedirs(output, exist_ok=True)
+        cmd = ['transrate2', '-a', assembly, '-l', left, '-r', right, '-o', output, '-t', str(threads), '-s']
+        trRun = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+        monitor = ResourceMonitor(trRun.pid)
+        self.setStatus(keys, 'starting')
+        tail    = deque(maxlen=LOG_TAIL)
+        loggers = [jobLogger(output, 'stdout'), jobLogger(output, 'stderr')]
+        readers = [threading.Thread(target=self.streamPipe, args=(pipe, logger, keys, tail), daemon=True)
+                   for pipe, logger in zip((trRun.stdout, trRun.stderr), loggers)]
+        for reader in readers:
+            reader.start()
+        trRun.wait()
+        resources = monitor.stop()
+        resources['threads'] = threads
+        for reader in readers:
+            reader.join()
+        for logger in loggers:
+            closeLogger(logger)
+        self.setStatus(keys, None)
         if trRun.returncode != 0:
-            print(f'{keys[0]:<10}{keys[1]:<10}FAILED')
+            lastLines = '\n'.join(f'    {l}' for l in tail)
+            self.log(f'{keys[0]:<10}{keys[1]:<10}FAILED ({trRun.returncode}), see {os.path.join(output, "logs")}\n{lastLines}')
+            self.saveProgress(attempt, 'failed', resources)
         else:
-            self.saveProgress(keys[0], keys[1])
-        self.transrateCleanup(output)
+            self.saveProgress(attempt, 'done', resources)
+        self.transrateCleanup(output, threads)
+        return resources
 
-    def transrateCleanup(self, output):
-        for root, dirs, files in os.walk(output):
+    # one bottom up walk: kept files go to the top of output, everything else outside logs/ is removed
+    def transrateCleanup(self, output, threads=1):
+        keep = ('.sam', '.bam', '.bai', '.csv', '.fa')
+        for root, dirs, files in os.walk(output, topdown=False):
+            inLogs = 'logs' in os.path.relpath(root, output).split(os.sep)
             for file in files:
-                if file.endswith(('.sam', '.bam', '.bai', '.csv', '.fa')):
-                    os.rename(os.path.join(root, file), os.path.join(output, file))
-        for root, dirs, files in os.walk(output):
+                path = os.path.join(root, file)
+                if inLogs:
+                    continue
+                if not file.endswith(keep):
+                    os.remove(path)
+                elif self.compact and file.endswith('.sam'):
+                    self.compactSam(path, output, threads)
+                elif root != output:
+                    os.rename(path, os.path.join(output, file))
             for d in dirs:
-                if d != 'logs':
-                    shutil.rmtree(os.path.join(root, d))
-            for file in files:
-                if not file.endswith(('.sam', '.bam', '.bai', '.csv', '.fa')) and 'logs' not in root:
-                    os.remove(os.path.join(root, file))
-
-    def saveProgress(self, key, organism):
-        progress_data = {}
-        if os.path.exists('progress.json'):
-            with open('progress.json', 'r') as progress_file:
-                progress_data = json.load(progress_file)
-        
-        if key in progress_data:
-            if organism not in progress_data[key]:
-                progress_data[key].append(organism)
-        else:
-            progress_data[key] = [organism]
-        
-        with open('progress.json', 'w') as progress_file:
-            json.dump(progress_data, progress_file, indent=4)
+                if inLogs or (root == output and d == 'logs'):
+                    continue
+                shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+
+    # sam -> coordinate sorted + indexed bam, the sam is only removed if the record counts match
+    def compactSam(self, sam, output, threads=1):
+        import pysam
+        base   = os.path.basename(sam)[:-len('.sam')]
+        # the sam's own directory still gets moved into output after it, so a name is only free if
+        # it's free in both. next to a sorted bam it mustn't end in sorted.bam, or discovery takes it
+        # as a second bam of the sample, and nothing already there is overwritten
+        taken  = lambda name: any(os.path.exists(os.path.join(d, name)) for d in (os.path.dirname(sam), output))
+        names  = [n for n in (f'{base}.sorted.bam', f'{base}.sam.bam') if not taken(n) and not taken(f'{n}.bai')]
+        if not names:
+            self.log(f'{sam} compaction skipped, {base}.sorted.bam and {base}.sam.bam both exist, keeping sam')
+            if os.path.dirname(sam) != output.rstrip(os.sep):
+                os.rename(sam, os.path.join(output, os.path.basename(sam)))
+            return None
+        target = os.path.join(output, names[0])
+        try:
+            pysam.sort('-@', str(threads), '-o', target, sam)
+            pysam.index('-@', str(threads), target)
+            samCount = int(pysam.view('-c', sam))
+            bamCount = int(pysam.view('-c', '-@', str(threads), target))
+        except Exception as e:
+            samCount, bamCount = -1, -2
+            self.log(f'{sam} compaction error: {e}')
+        if samCount == bamCount:
+            os.remove(sam)
+            return target
+        self.log(f'{sam} compaction mismatch ({samCount} sam vs {bamCount} bam records), keeping sam')
+        for f in (target, f'{target}.bai'):
+            if os.path.exists(f):
+                os.remove(f)
+        if os.path.dirname(sam) != output.rstrip(os.sep):
+            os.rename(sam, os.path.join(output, os.path.basename(sam)))
+        return None
+
+    def saveProgress(self, attempt, status, resources=None):
+        if attempt is not None:
+            self.ledger.finish(attempt, status, resources)
 
+    # progress.json is only read once to seed the ledger, after that the ledger is the record
     def loadProgress(self):
-        progress_data = {}
-        if os.path.exists('progress.json'):
-            with open('progress.json', 'r') as progress_file:
-                progress_data = json.load(progress_file)
-        self.progress_data = progress_data
-
-            
-        
+        self.ledger = Ledger()
+        self.ledger.import_progress('progress.json', 'transrate')
+        self.progress_data = self.ledger.fingerprints('transrate')
 
 
 main = Herbaria()
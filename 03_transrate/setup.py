@@ -1,10 +1,16 @@
 import os
+import sys
+import argparse
 
-dal   = ['DAL192', 'DAL193', 'DAL195', 'DAL212', 'DAL218', 'DAL224', 'DAL227']
-wa    = ['WA02', 'WA03', 'WA07', 'WA08', 'WA09', 'WA11', 'WA12', 'WA13', 'WA14', 'WA18', 'WA22', 'WA25', 'WA26']
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_scripts'))
+import registry
 
-for d in dal:
-    os.makedirs(d, exist_ok=True)
+# one directory per sample in the manifest (00_scripts/samples.tsv)
+parser = argparse.ArgumentParser(description='Sample directories for the manifest samples')
+registry.add_arguments(parser)
+args   = parser.parse_args()
+chosen = registry.selection(args)
 
-for w in wa:
-    os.makedirs(w, exist_ok=True)
\ No newline at end of file
+for s in registry.load():
+    if registry.selected(s, chosen):
+        os.makedirs(s, exist_ok=True)